@@ -1,27 +1,33 @@
 import os
+import json
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Request, HTTPException, Header
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from dotenv import load_dotenv
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-import google.generativeai as genai
 import uvicorn
 from .models import conversation
 from .chains import context_injection
 from .enum import separation
 from .repository import conversation_repo
 from . import database
+from rag.retrieval import get_engine, build_where
+from rag.reranker import RERANK_ENABLED
+from rag.context_packer import pack_context
+from rag import gemini_client
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-# ChromaDB setup
-CHROMA_DIR = os.path.join(os.getcwd(), "chromadb_data")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-collection = chroma_client.get_or_create_collection("motoko_code_samples")
-embedding_fn = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+# Shared retrieval engine; embedder and collection load on a background thread
+# (or on the first query when RAG_WARMUP=0), so startup does not wait for them
+engine = get_engine()
+engine.start_warm_up()
 
 GENERATION_CONFIG = {
     "temperature": 0.7,
@@ -30,25 +36,73 @@ GENERATION_CONFIG = {
     "max_output_tokens": 4096,
 }
 MODEL_NAME = "models/gemini-2.5-flash"
+
+# Per-process concurrency: requests beyond MAX_CONCURRENT_REQUESTS are rejected with 503
+# instead of queueing; blocking work (embedding, Chroma, SQLite) runs on a bounded pool.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("API_MAX_CONCURRENT_REQUESTS", "16"))
+WORKER_THREADS = int(os.getenv("API_WORKER_THREADS", "8"))
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="api-worker")
+request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Chunks retrieved per chat request; re-ranked top results are precise enough to send fewer
+CONTEXT_RESULTS = int(os.getenv("API_CONTEXT_RESULTS", "10"))
+RERANKED_CONTEXT_RESULTS = int(os.getenv("API_RERANKED_CONTEXT_RESULTS", "5"))
+
 chain = context_injection.ContextInjectionHandler()
 conversation_repo.init_schema()
-def retrieve_context(query, n_results=10):
-    query_emb = embedding_fn([query])[0]
-    results = collection.query(query_embeddings=[query_emb], n_results=n_results)
-    docs = results.get("documents", [[]])[0]
-    metadatas = results.get("metadatas", [[]])[0]
-    return docs, metadatas
-
-def answer_with_gemini_sdk(query, context):
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(
-        MODEL_NAME,
-        generation_config=GENERATION_CONFIG
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the worker pool without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+def retrieve_context(query, n_results=CONTEXT_RESULTS, where=None, rerank=None):
+    return engine.retrieve_context(query, n_results, where, rerank)
+
+def _gemini_model():
+    # Built once and shared; per-request sampling settings are passed as overrides
+    return gemini_client.get_model(MODEL_NAME, GENERATION_CONFIG, api_key=GEMINI_API_KEY)
+
+def request_overrides(body):
+    """Gemini generation_config overrides from the OpenAI-style request body."""
+    return gemini_client.generation_overrides(
+        temperature=body.temperature, top_p=body.top_p, max_tokens=body.max_tokens
+    )
+
+def build_prompt(query, context):
+    return f"Context:\n{context}\n\nRequest: {query}\nAnswer:"
+
+async def answer_with_gemini_sdk(query, context, overrides=None):
+    model = _gemini_model()
+    response = await model.generate_content_async(
+        build_prompt(query, context), generation_config=overrides or None
     )
-    prompt = f"Context:\n{context}\n\nRequest: {query}\nAnswer:"
-    response = model.generate_content(prompt)
     return response.text
 
+async def stream_with_gemini_sdk(query, context, overrides=None):
+    """Yield the answer text chunk by chunk as Gemini generates it."""
+    model = _gemini_model()
+    response = await model.generate_content_async(
+        build_prompt(query, context), generation_config=overrides or None, stream=True
+    )
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. only finish metadata)
+            continue
+        if text:
+            yield text
+
+def split_answer(answer):
+    """Split a model answer into (visible answer, summary) at the separator.
+
+    The summary is what gets persisted as the assistant turn; if the model
+    skipped the separator the whole answer is kept instead.
+    """
+    visible, _, summary = answer.partition(separation.Separation.SEPRATION.value)
+    return visible.strip(), (summary.strip() or visible.strip())
+
 # OpenAI-compatible request/response models
 class Message(BaseModel):
     role: str
@@ -67,6 +121,12 @@ class ChatCompletionRequest(BaseModel):
     logit_bias: Optional[Dict[str, float]] = None
     user: Optional[str] = None
     conversation_id: Optional[int] = None
+    # Retrieval filters (non-OpenAI extensions)
+    project: Optional[str] = None
+    file_type: Optional[str] = None
+    has_toml: Optional[bool] = None
+    # Cross-encoder re-ranking of retrieved chunks; None uses RAG_RERANK
+    rerank: Optional[bool] = None
 app = FastAPI(title="Motoko Coder RAG API", version="1.0.0")
 
 
@@ -76,11 +136,47 @@ async def chat_completions(
     body: ChatCompletionRequest,
     x_api_key: str = Header(None)
 ):
+    # Shed load instead of queueing requests behind slow LLM calls
+    if request_slots.locked():
+        raise HTTPException(status_code=503, detail="Server is busy, please retry", headers={"Retry-After": "1"})
+    await request_slots.acquire()
+    try:
+        final_convo, query, context = await _prepare_chat(body, x_api_key)
+        if body.stream:
+            # Released by the stream's finally (the body raised) or the background task
+            # (the client left before the body started); whichever runs first wins
+            release_slot = _release_once(request_slots)
+            return StreamingResponse(
+                _stream_chat_completion(body, final_convo, query, context, release_slot),
+                media_type="text/event-stream",
+                background=BackgroundTask(release_slot),
+            )
+    except BaseException:
+        request_slots.release()
+        raise
+    try:
+        return await _chat_completion(body, final_convo, query, context)
+    finally:
+        request_slots.release()
+
+def _release_once(semaphore):
+    """A callable that releases semaphore on its first call and does nothing afterwards."""
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            semaphore.release()
+    return release
+
+async def _prepare_chat(body: ChatCompletionRequest, x_api_key: Optional[str]):
+    """Authenticate, retrieve context and load the conversation. Returns (convo, query, context)."""
     # API key validation using database
     if not x_api_key:
         raise HTTPException(status_code=401, detail="Missing API key")
     
-    valid, user_id, message = database.validate_api_key(x_api_key)
+    valid, user_id, message = await run_blocking(database.validate_api_key, x_api_key)
     if not valid:
         raise HTTPException(status_code=401, detail="Invalid API key")
 
@@ -90,35 +186,55 @@ async def chat_completions(
         raise HTTPException(status_code=400, detail="No user message found.")
     query = user_messages[-1].content
 
-    # Retrieve context and answer
-    docs, metadatas = retrieve_context(query)
+    # Retrieve context and load the conversation concurrently
+    where = build_where(project=body.project, file_type=body.file_type, has_toml=body.has_toml)
+    rerank = RERANK_ENABLED if body.rerank is None else body.rerank
+    n_results = RERANKED_CONTEXT_RESULTS if rerank else CONTEXT_RESULTS
+    retrieval = run_blocking(retrieve_context, query, n_results, where=where, rerank=rerank)
+    if body.conversation_id is not None:
+        (docs, metadatas), convo = await asyncio.gather(
+            retrieval, run_blocking(conversation_repo.load_conversation, body.conversation_id)
+        )
+    else:
+        docs, metadatas = await retrieval
+        convo = conversation.Conversation()
+    # Drop duplicate snippets and keep the rest within the context token budget
+    docs, metadatas = pack_context(docs, metadatas)
     context = "\n---\n".join(docs)
-    convo = conversation.Conversation()
-    if(body.conversation_id is not None):
-        convo = conversation_repo.load_conversation(body.conversation_id)
 
     convo.set_user_id(user_id)
     convo.set_new_message(query)
+    # Only recent turns plus a rolling summary of older ones go to the model
+    convo.compact_history()
     final_convo = chain.handle(convo)
-    answer = answer_with_gemini_sdk(final_convo.build_conversation_history(), context)
-    print(answer)
+    return final_convo, query, context
+
+async def _save_turn(final_convo, query, summary):
     final_convo.add_turn("user", query)
-    final_convo.add_turn("system", answer.split(separation.Separation.SEPRATION.value, 1)[1].strip())
+    final_convo.add_turn("system", summary)
     final_convo.set_new_message(query)
-    conversation_repo.save_conversation(final_convo)
+    await run_blocking(conversation_repo.save_conversation, final_convo)
+
+async def _chat_completion(body: ChatCompletionRequest, final_convo, query, context):
+    answer = await answer_with_gemini_sdk(
+        final_convo.build_conversation_history(), context, request_overrides(body)
+    )
+    print(answer)
+    content, summary = split_answer(answer)
+    await _save_turn(final_convo, query, summary)
 
     # OpenAI-compatible response
     response = {
         "id": "chatcmpl-motoko-001",
         "object": "chat.completion",
-        "created": int(__import__('time').time()),
+        "created": int(time.time()),
         "model": body.model or MODEL_NAME,
         "choices": [
             {
                 "index": 0,
                 "message": {
                     "role": "assistant",
-                    "content": answer.split(separation.Separation.SEPRATION.value, 1)[0].strip()
+                    "content": content
                 },
                 "finish_reason": "stop"
             }
@@ -133,6 +249,78 @@ async def chat_completions(
 
     return JSONResponse(content=response)
 
+async def _stream_chat_completion(body: ChatCompletionRequest, final_convo, query, context, release_slot):
+    """OpenAI-compatible SSE stream of chat.completion.chunk events.
+
+    Text is forwarded as soon as Gemini produces it. Everything after the
+    separator is the summary: it is held back from the client and persisted
+    with the conversation once generation finishes. release_slot frees the
+    caller's request slot however the stream ends.
+    """
+    created = int(time.time())
+    model_name = body.model or MODEL_NAME
+    separator = separation.Separation.SEPRATION.value
+
+    def event(delta, finish_reason=None, **extra):
+        payload = {
+            "id": "chatcmpl-motoko-001",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            **extra
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    try:
+        yield event({"role": "assistant", "content": ""})
+        answer_parts, summary_parts = [], []
+        pending = ""  # Tail that might be the start of the separator
+        in_summary = False
+        try:
+            history = final_convo.build_conversation_history()
+            async for text in stream_with_gemini_sdk(history, context, request_overrides(body)):
+                if in_summary:
+                    summary_parts.append(text)
+                    continue
+                pending += text
+                index = pending.find(separator)
+                if index != -1:
+                    visible = pending[:index]
+                    summary_parts.append(pending[index + len(separator):])
+                    pending = ""
+                    in_summary = True
+                else:
+                    cut = max(len(pending) - (len(separator) - 1), 0)
+                    visible, pending = pending[:cut], pending[cut:]
+                if not answer_parts:
+                    visible = visible.lstrip()
+                if visible:
+                    answer_parts.append(visible)
+                    yield event({"content": visible})
+            if pending:
+                answer_parts.append(pending)
+                yield event({"content": pending})
+        except Exception as e:
+            print(f"Error while streaming completion: {e}")
+            yield f"data: {json.dumps({'error': {'message': str(e), 'type': 'server_error'}})}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+
+        answer = "".join(answer_parts)
+        summary = "".join(summary_parts).strip() or answer.strip()
+        await _save_turn(final_convo, query, summary)
+        yield event({}, finish_reason="stop", conversation_id=final_convo.id)
+        yield "data: [DONE]\n\n"
+    finally:
+        release_slot()
+
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once the embedder and collection are loaded, 503 before."""
+    readiness = engine.readiness()
+    return JSONResponse(status_code=200 if readiness["ready"] else 503, content=readiness)
+
 @app.get("/")
 def root():
     return {
@@ -1,13 +1,20 @@
 from fastapi import FastAPI, HTTPException, Depends, status
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import Optional, List
-from . import database
+from dotenv import load_dotenv
+
+# SESSION_SECRET, SESSION_TOKEN_TTL and API_KEY_HASH_SECRET are read at import
+load_dotenv()
+
+from . import database, session_tokens
 from datetime import datetime
 
 app = FastAPI(title="Motoko Coder Auth API", version="1.0.0")
-security = HTTPBasic()
+# Bearer session tokens from /login are preferred; Basic auth still works but runs the password KDF
+bearer_security = HTTPBearer(auto_error=False)
+basic_security = HTTPBasic(auto_error=False)
 
 # Pydantic models
 class UserRegistration(BaseModel):
@@ -35,21 +42,30 @@ class UserResponse(BaseModel):
     email: Optional[str] = None
     created_at: str
 
-def get_current_user(credentials: HTTPBasicCredentials = Depends(security)):
-    """Get current user from basic auth credentials."""
-    success, user_id, message = database.authenticate_user(
-        credentials.username, credentials.password
-    )
-    if not success:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid credentials",
-            headers={"WWW-Authenticate": "Basic"},
+def get_current_user(
+    bearer: Optional[HTTPAuthorizationCredentials] = Depends(bearer_security),
+    credentials: Optional[HTTPBasicCredentials] = Depends(basic_security)
+):
+    """Get current user from a session token, falling back to basic auth credentials."""
+    if bearer is not None:
+        claims = session_tokens.verify_token(bearer.credentials)
+        if claims is not None:
+            return claims["sub"]
+    elif credentials is not None:
+        success, user_id, message = database.authenticate_user(
+            credentials.username, credentials.password
         )
-    return user_id
+        if success:
+            return user_id
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid credentials",
+        headers={"WWW-Authenticate": "Bearer, Basic"},
+    )
 
+# Registration and login hash passwords, so they run in the threadpool rather than on the event loop
 @app.post("/register", response_model=dict)
-async def register_user(user_data: UserRegistration):
+def register_user(user_data: UserRegistration):
     """Register a new user."""
     success, message = database.create_user(
         user_data.username, user_data.password, user_data.email
@@ -61,8 +77,8 @@ async def register_user(user_data: UserRegistration):
         raise HTTPException(status_code=400, detail=message)
 
 @app.post("/login", response_model=dict)
-async def login_user(user_data: UserLogin):
-    """Login user and return user info."""
+def login_user(user_data: UserLogin):
+    """Login user and return user info with a session token."""
     success, user_id, message = database.authenticate_user(
         user_data.username, user_data.password
     )
@@ -72,7 +88,10 @@ async def login_user(user_data: UserLogin):
             "success": True,
             "message": message,
             "user_id": user_id,
-            "username": user_data.username
+            "username": user_data.username,
+            "access_token": session_tokens.issue_token(user_id, user_data.username),
+            "token_type": "bearer",
+            "expires_in": session_tokens.SESSION_TOKEN_TTL
         }
     else:
         raise HTTPException(status_code=401, detail=message)
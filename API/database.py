@@ -1,16 +1,123 @@
 import sqlite3
 import hashlib
+import hmac
 import secrets
 import string
-from datetime import datetime, timedelta
+import threading
+import atexit
+import time
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Tuple
 import os
+from dotenv import load_dotenv
+from rag.cache import TTLCache
+
+# Every server imports this module before reading its own settings, and init_database()
+# below hashes migrated keys with API_KEY_HASH_SECRET, so .env must be loaded first
+load_dotenv()
 
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), "motoko_coder.db")
 
+# Connection pool settings shared by every SQLite database of the API
+BUSY_TIMEOUT_SECONDS = 5.0
+STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+
+_local = threading.local()
+
+# Validated API keys are cached for a short TTL so auth is a dict lookup on the hot path.
+# revoke_api_key() invalidates this process immediately; other processes within the TTL.
+API_KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "10"))
+API_KEY_CACHE_SIZE = 10000
+# last_used updates are coalesced in memory and written in one batch every few seconds
+LAST_USED_FLUSH_INTERVAL = float(os.getenv("API_KEY_LAST_USED_FLUSH_INTERVAL", "5"))
+
+_api_key_cache = TTLCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)  # key_hash -> (key_id, user_id)
+# Replaced by every revocation; all processes stat it before serving a cached key
+REVOCATION_MARKER_PATH = DATABASE_PATH + ".revocations"
+_revocation_stamp = None
+_pending_last_used = {}  # key_id -> last use timestamp
+_pending_lock = threading.Lock()
+_flusher = None
+
+def get_connection(path: str = DATABASE_PATH) -> sqlite3.Connection:
+    """Return this thread's pooled connection to `path`, opening it on first use.
+
+    Connections stay open for the life of the thread, so repeated queries reuse
+    sqlite3's prepared-statement cache. WAL journaling lets readers proceed while
+    a writer commits, and the busy timeout waits for the writer lock instead of
+    failing immediately.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT_SECONDS * 1000)}")
+        connections[path] = conn
+    return conn
+
+def _revocation_marker_stamp():
+    try:
+        stat = os.stat(REVOCATION_MARKER_PATH)
+    except FileNotFoundError:
+        return None
+    # The marker is replaced, not rewritten, so the inode changes even within one mtime tick
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+def _check_revocations():
+    """Drop cached keys if any process has revoked a key since the last check."""
+    global _revocation_stamp
+    stamp = _revocation_marker_stamp()
+    if stamp != _revocation_stamp:
+        _api_key_cache.clear()
+        _revocation_stamp = stamp
+
+def _mark_revocation():
+    tmp_path = f"{REVOCATION_MARKER_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, REVOCATION_MARKER_PATH)
+
+def _record_key_use(key_id: int):
+    """Remember that a key was used; the flusher thread writes it to the database later."""
+    global _flusher
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    with _pending_lock:
+        _pending_last_used[key_id] = timestamp
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="api-key-last-used", daemon=True)
+            _flusher.start()
+
+def flush_last_used():
+    """Write all pending last_used timestamps in a single transaction."""
+    with _pending_lock:
+        if not _pending_last_used:
+            return
+        pending = list(_pending_last_used.items())
+        _pending_last_used.clear()
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany(
+                "UPDATE api_keys SET last_used = ? WHERE id = ?",
+                [(timestamp, key_id) for key_id, timestamp in pending]
+            )
+    except Exception as e:
+        print(f"Error flushing API key last_used: {str(e)}")
+
+def _flush_loop():
+    while True:
+        time.sleep(LAST_USED_FLUSH_INTERVAL)
+        flush_last_used()
+
+atexit.register(flush_last_used)
+
 def init_database():
     """Initialize the database with required tables."""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Create users table
@@ -25,26 +132,109 @@ def init_database():
         )
     ''')
     
-    # Create api_keys table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_keys (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            api_key TEXT UNIQUE NOT NULL,
-            name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_used TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
+    # Create api_keys table (keys are stored as a keyed hash, never in plaintext)
+    cursor.execute(API_KEYS_TABLE_SQL.format(table="api_keys"))
     conn.commit()
-    conn.close()
+
+    _migrate_plaintext_api_keys(conn)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_user_active ON api_keys (user_id, is_active)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_prefix ON api_keys (key_prefix)")
+    conn.commit()
+
+def _migrate_plaintext_api_keys(conn: sqlite3.Connection):
+    """Rebuild an api_keys table from older databases that stored keys in plaintext."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(api_keys)")]
+    if "api_key" not in columns:
+        return
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS api_keys_migrated")
+        conn.execute(API_KEYS_TABLE_SQL.format(table="api_keys_migrated"))
+        rows = conn.execute(
+            "SELECT id, user_id, api_key, name, created_at, last_used, is_active FROM api_keys"
+        ).fetchall()
+        conn.executemany(
+            '''INSERT INTO api_keys_migrated
+               (id, user_id, key_prefix, key_hash, name, created_at, last_used, is_active)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            [
+                (key_id, user_id, api_key_prefix(api_key), hash_api_key(api_key), name, created_at, last_used, is_active)
+                for key_id, user_id, api_key, name, created_at, last_used, is_active in rows
+            ]
+        )
+        conn.execute("DROP TABLE api_keys")
+        conn.execute("ALTER TABLE api_keys_migrated RENAME TO api_keys")
+    print(f"Migrated {len(rows)} API keys to hashed storage")
+
+API_KEYS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        key_prefix TEXT NOT NULL,
+        key_hash TEXT UNIQUE NOT NULL,
+        name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_used TIMESTAMP,
+        is_active BOOLEAN DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+'''
+
+# Leading characters of a key kept in clear for indexed lookup and display
+API_KEY_PREFIX_LENGTH = 8
+
+# Read once: every key of this process must be hashed under the same secret
+API_KEY_HASH_SECRET = os.getenv("API_KEY_HASH_SECRET", "").encode()
+if not API_KEY_HASH_SECRET:
+    print("API_KEY_HASH_SECRET not set; API keys are stored under an unkeyed hash. "
+          "Set it before creating keys: changing it later invalidates every stored key")
+
+def api_key_prefix(api_key: str) -> str:
+    return api_key[:API_KEY_PREFIX_LENGTH]
+
+def hash_api_key(api_key: str) -> str:
+    """Keyed hash (HMAC-SHA256) of an API key.
+
+    Keys are long random strings, so a fast hash is enough; the server-side
+    API_KEY_HASH_SECRET keeps a leaked database from being checked offline
+    (only when it is set: with an empty secret this is a plain HMAC anyone can
+    recompute). Changing the secret invalidates every stored key.
+    """
+    return hmac.new(API_KEY_HASH_SECRET, api_key.encode(), hashlib.sha256).hexdigest()
+
+# scrypt cost parameters; hashes record their own, so raising these only affects new hashes
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+PASSWORD_SALT_BYTES = 16
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024)
 
 def hash_password(password: str) -> str:
-    """Hash a password using SHA-256."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash a password with a salted scrypt KDF, stored as scrypt$n$r$p$salt$hash."""
+    salt = secrets.token_bytes(PASSWORD_SALT_BYTES)
+    n, r, p = PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+    digest = _scrypt(password, salt, n, r, p)
+    return f"scrypt${n}${r}${p}${salt.hex()}${digest.hex()}"
+
+def verify_password(password: str, password_hash: str) -> Tuple[bool, bool]:
+    """Check a password against a stored hash. Returns (valid, needs_rehash).
+
+    Unsalted SHA-256 hashes from older databases are still accepted and flagged
+    for rehashing, as are scrypt hashes made with weaker cost parameters.
+    """
+    if not password_hash.startswith("scrypt$"):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, password_hash), True
+    try:
+        _, n, r, p, salt, digest = password_hash.split("$")
+        n, r, p = int(n), int(r), int(p)
+        candidate = _scrypt(password, bytes.fromhex(salt), n, r, p)
+    except ValueError:
+        return False, False
+    valid = hmac.compare_digest(candidate.hex(), digest)
+    return valid, (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
 
 def generate_api_key(length: int = 32) -> str:
     """Generate a random API key."""
@@ -54,24 +244,21 @@ def generate_api_key(length: int = 32) -> str:
 def create_user(username: str, password: str, email: Optional[str] = None) -> Tuple[bool, str]:
     """Create a new user. Returns (success, message)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Check if username already exists
-        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        if cursor.fetchone():
-            conn.close()
-            return False, "Username already exists"
-        
-        # Hash password and create user
-        password_hash = hash_password(password)
-        cursor.execute(
-            "INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)",
-            (username, password_hash, email)
-        )
-        
-        conn.commit()
-        conn.close()
+        conn = get_connection()
+        with conn:
+            cursor = conn.cursor()
+            
+            # Check if username already exists
+            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+            if cursor.fetchone():
+                return False, "Username already exists"
+            
+            # Hash password and create user
+            password_hash = hash_password(password)
+            cursor.execute(
+                "INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)",
+                (username, password_hash, email)
+            )
         return True, "User created successfully"
         
     except Exception as e:
@@ -80,22 +267,29 @@ def create_user(username: str, password: str, email: Optional[str] = None) -> Tu
 def authenticate_user(username: str, password: str) -> Tuple[bool, Optional[int], str]:
     """Authenticate a user. Returns (success, user_id, message)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         cursor = conn.cursor()
         
-        password_hash = hash_password(password)
         cursor.execute(
-            "SELECT id FROM users WHERE username = ? AND password_hash = ? AND is_active = 1",
-            (username, password_hash)
+            "SELECT id, password_hash FROM users WHERE username = ? AND is_active = 1",
+            (username,)
         )
         
         result = cursor.fetchone()
-        conn.close()
         
         if result:
-            return True, result[0], "Authentication successful"
-        else:
-            return False, None, "Invalid username or password"
+            user_id, password_hash = result
+            valid, needs_rehash = verify_password(password, password_hash)
+            if valid:
+                if needs_rehash:
+                    # Upgrade legacy hashes transparently on successful login
+                    with conn:
+                        conn.execute(
+                            "UPDATE users SET password_hash = ? WHERE id = ?",
+                            (hash_password(password), user_id)
+                        )
+                return True, user_id, "Authentication successful"
+        return False, None, "Invalid username or password"
             
     except Exception as e:
         return False, None, f"Authentication error: {str(e)}"
@@ -103,25 +297,22 @@ def authenticate_user(username: str, password: str) -> Tuple[bool, Optional[int]
 def create_api_key(user_id: int, name: Optional[str] = None) -> Tuple[bool, Optional[str], str]:
     """Create a new API key for a user. Returns (success, api_key, message)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Generate unique API key
-        while True:
+        conn = get_connection()
+        # 190 random bits make a collision practically impossible; the UNIQUE
+        # constraint on key_hash catches one anyway and we simply draw again.
+        for _ in range(5):
             api_key = generate_api_key()
-            cursor.execute("SELECT id FROM api_keys WHERE api_key = ?", (api_key,))
-            if not cursor.fetchone():
-                break
-        
-        # Insert API key
-        cursor.execute(
-            "INSERT INTO api_keys (user_id, api_key, name) VALUES (?, ?, ?)",
-            (user_id, api_key, name or f"API Key {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-        )
-        
-        conn.commit()
-        conn.close()
-        return True, api_key, "API key created successfully"
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT INTO api_keys (user_id, key_prefix, key_hash, name) VALUES (?, ?, ?, ?)",
+                        (user_id, api_key_prefix(api_key), hash_api_key(api_key),
+                         name or f"API Key {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+                    )
+            except sqlite3.IntegrityError:
+                continue
+            return True, api_key, "API key created successfully"
+        return False, None, "Error creating API key: could not generate a unique key"
         
     except Exception as e:
         return False, None, f"Error creating API key: {str(e)}"
@@ -129,26 +320,33 @@ def create_api_key(user_id: int, name: Optional[str] = None) -> Tuple[bool, Opti
 def validate_api_key(api_key: str) -> Tuple[bool, Optional[int], str]:
     """Validate an API key. Returns (valid, user_id, message)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        key_hash = hash_api_key(api_key)
+        _check_revocations()
+        cached = _api_key_cache.get(key_hash)
+        if cached is not None:
+            key_id, user_id = cached
+            _record_key_use(key_id)
+            return True, user_id, "API key is valid"
+
+        conn = get_connection()
         cursor = conn.cursor()
         
+        # Indexed prefix lookup, then a constant-time comparison of the hashes
         cursor.execute(
-            "SELECT user_id FROM api_keys WHERE api_key = ? AND is_active = 1",
-            (api_key,)
+            "SELECT id, user_id, key_hash FROM api_keys WHERE key_prefix = ? AND is_active = 1",
+            (api_key_prefix(api_key),)
         )
         
-        result = cursor.fetchone()
+        result = None
+        for key_id, user_id, stored_hash in cursor.fetchall():
+            if hmac.compare_digest(stored_hash, key_hash):
+                result = (key_id, user_id)
         if result:
-            # Update last_used timestamp
-            cursor.execute(
-                "UPDATE api_keys SET last_used = CURRENT_TIMESTAMP WHERE api_key = ?",
-                (api_key,)
-            )
-            conn.commit()
-            conn.close()
-            return True, result[0], "API key is valid"
+            key_id, user_id = result
+            _api_key_cache.put(key_hash, (key_id, user_id))
+            _record_key_use(key_id)
+            return True, user_id, "API key is valid"
         else:
-            conn.close()
             return False, None, "Invalid API key"
             
     except Exception as e:
@@ -156,12 +354,14 @@ def validate_api_key(api_key: str) -> Tuple[bool, Optional[int], str]:
 
 def get_user_api_keys(user_id: int) -> list:
     """Get all API keys for a user."""
+    # Show up-to-date last_used values
+    flush_last_used()
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         cursor = conn.cursor()
         
         cursor.execute(
-            "SELECT id, api_key, name, created_at, last_used FROM api_keys WHERE user_id = ? AND is_active = 1",
+            "SELECT id, key_prefix, name, created_at, last_used FROM api_keys WHERE user_id = ? AND is_active = 1",
             (user_id,)
         )
         
@@ -169,13 +369,13 @@ def get_user_api_keys(user_id: int) -> list:
         for row in cursor.fetchall():
             keys.append({
                 "id": row[0],
-                "api_key": row[1],
+                # Only the prefix is stored; the full key is shown once, at creation
+                "api_key": f"{row[1]}...",
                 "name": row[2],
                 "created_at": row[3],
                 "last_used": row[4]
             })
         
-        conn.close()
         return keys
         
     except Exception as e:
@@ -184,20 +384,22 @@ def get_user_api_keys(user_id: int) -> list:
 def revoke_api_key(user_id: int, api_key_id: int) -> Tuple[bool, str]:
     """Revoke an API key. Returns (success, message)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "UPDATE api_keys SET is_active = 0 WHERE id = ? AND user_id = ?",
-            (api_key_id, user_id)
-        )
+        conn = get_connection()
+        with conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "UPDATE api_keys SET is_active = 0 WHERE id = ? AND user_id = ?",
+                (api_key_id, user_id)
+            )
+            revoked = cursor.rowcount > 0
         
-        if cursor.rowcount > 0:
-            conn.commit()
-            conn.close()
+        if revoked:
+            _api_key_cache.pop_where(lambda key, value: value[0] == api_key_id)
+            # API servers run in other processes; they see the marker on their next validation
+            _mark_revocation()
             return True, "API key revoked successfully"
         else:
-            conn.close()
             return False, "API key not found or not owned by user"
             
     except Exception as e:
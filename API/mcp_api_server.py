@@ -2,20 +2,19 @@ import os
 from fastapi import FastAPI, Request, HTTPException, Header
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from dotenv import load_dotenv
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from .database import validate_api_key
+from rag.retrieval import get_engine, format_context_result, build_where, MAX_BATCH_QUERIES
+from rag.context_packer import pack_context
 
 # Load environment variables
 load_dotenv()
 
-# ChromaDB setup
-CHROMA_DIR = os.path.join(os.getcwd(), "chromadb_data")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-collection = chroma_client.get_or_create_collection("motoko_code_samples")
-embedding_fn = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+# Shared retrieval engine; embedder and collection load on a background thread
+# (or on the first query when RAG_WARMUP=0), so startup does not wait for them
+engine = get_engine()
+engine.start_warm_up()
 
 app = FastAPI(title="ICP_Coder", version="1.0.0")
 
@@ -23,9 +22,26 @@ class MCPContextRequest(BaseModel):
     query: str
     api_key: str
     max_results: Optional[int] = 5
+    # Optional filters, e.g. file_type="motoko" to leave out mops.toml files
+    project: Optional[str] = None
+    file_type: Optional[str] = None
+    has_toml: Optional[bool] = None
+    # Cross-encoder re-ranking of over-fetched candidates; None uses RAG_RERANK
+    rerank: Optional[bool] = None
 
+class MCPBatchContextRequest(BaseModel):
+    queries: List[str]
+    api_key: str
+    max_results: Optional[int] = 5
+    project: Optional[str] = None
+    file_type: Optional[str] = None
+    has_toml: Optional[bool] = None
+    rerank: Optional[bool] = None
+
+# Plain def: FastAPI runs these in its threadpool, so embedding, ChromaDB and SQLite
+# calls do not block the event loop for other requests
 @app.post("/v1/mcp/context")
-async def get_motoko_context(
+def get_motoko_context(
     body: MCPContextRequest
 ):
     # Log the query received from the LLM
@@ -36,28 +52,15 @@ async def get_motoko_context(
     if not valid:
         raise HTTPException(status_code=401, detail="Invalid API key")
     try:
-        # Generate query embedding
-        query_emb = embedding_fn([body.query])[0]
         # Search for relevant documents
-        results = collection.query(
-            query_embeddings=[query_emb],
-            n_results=body.max_results
-        )
-        docs = results.get("documents", [[]])[0]
-        metadatas = results.get("metadatas", [[]])[0]
-        # Format context
-        context_parts = []
-        for i, (doc, meta) in enumerate(zip(docs, metadatas)):
-            context_part = {
-                "index": i + 1,
-                "filename": meta.get("filename", "unknown"),
-                "project": meta.get("folders", "unknown"),
-                "file_type": meta.get("file_type", "unknown"),
-                "has_toml": meta.get("has_toml", False),
-                "content": doc[:1000] + "..." if len(doc) > 1000 else doc,
-                "full_path": meta.get("rel_path", "unknown")
-            }
-            context_parts.append(context_part)
+        where = build_where(project=body.project, file_type=body.file_type, has_toml=body.has_toml)
+        docs, metadatas = engine.retrieve_context(body.query, body.max_results, where, body.rerank)
+        # Deduplicate and fit the token budget, cutting only at declaration boundaries
+        docs, metadatas = pack_context(docs, metadatas)
+        context_parts = [
+            format_context_result(i + 1, doc, meta)
+            for i, (doc, meta) in enumerate(zip(docs, metadatas))
+        ]
         response = {
             "success": True,
             "query": body.query,
@@ -71,11 +74,58 @@ async def get_motoko_context(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to retrieve Motoko context: {str(e)}")
 
+@app.post("/v1/mcp/context/batch")
+def get_motoko_context_batch(
+    body: MCPBatchContextRequest
+):
+    """Context for several queries with one auth check, one embedding call and one collection query."""
+    print("Batch queries received from LLM:", body.queries)
+
+    if not body.queries:
+        raise HTTPException(status_code=400, detail="At least one query is required")
+    if len(body.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+
+    # Validate API key
+    valid, user_id, message = validate_api_key(body.api_key)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    try:
+        where = build_where(project=body.project, file_type=body.file_type, has_toml=body.has_toml)
+        results = []
+        for query, (docs, metadatas) in zip(body.queries, engine.retrieve_many(body.queries, body.max_results, where, body.rerank)):
+            docs, metadatas = pack_context(docs, metadatas)
+            context_parts = [
+                format_context_result(i + 1, doc, meta)
+                for i, (doc, meta) in enumerate(zip(docs, metadatas))
+            ]
+            results.append({
+                "query": query,
+                "context_count": len(context_parts),
+                "context": context_parts
+            })
+        response = {
+            "success": True,
+            "query_count": len(results),
+            "results": results,
+            "message": f"Retrieved context for {len(results)} queries"
+        }
+        return JSONResponse(content=response)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to retrieve Motoko context: {str(e)}")
+
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once the embedder and collection are loaded, 503 before."""
+    readiness = engine.readiness()
+    return JSONResponse(status_code=200 if readiness["ready"] else 503, content=readiness)
+
 @app.get("/")
 def root():
     return {
         "motoko_coder": "Motoko MCP API is running.",
         "version": "1.0.0",
         "endpoint": "/v1/mcp/context",
+        "batch_endpoint": "/v1/mcp/context/batch",
         "authentication": "api_key in POST body required"
     }
\ No newline at end of file
@@ -3,29 +3,22 @@ import os
 import json
 import time
 import re
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-import google.generativeai as genai
+import asyncio
+import threading
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from dotenv import load_dotenv
+from rag.retrieval import get_engine, build_where
+from rag.context_packer import pack_context
+from rag import gemini_client
+from rag.cache import TTLCache
 
 # Load environment variables
 load_dotenv()
 
-# ChromaDB Setup
-CHROMA_DIR = os.path.join(os.getcwd(), "chromadb_data")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-embedding_fn = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-
-try:
-    collection = chroma_client.get_collection(
-        name="motoko_code_samples", 
-        embedding_function=embedding_fn
-    )
-    print(f"✅ ChromaDB collection loaded with {collection.count()} Motoko samples")
-except Exception as e:
-    print(f"❌ Error accessing ChromaDB collection: {e}")
-    exit(1)
+# Shared retrieval engine (ChromaDB collection + embedder), loaded lazily;
+# run_server() starts a background warm-up so the port opens immediately
+engine = get_engine()
 
 # Gemini 2.5 Flash Setup
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -33,8 +26,8 @@ if not GEMINI_API_KEY:
     print("❌ Gemini API key not found in environment variables")
     exit(1)
 
-genai.configure(api_key=GEMINI_API_KEY)
-print("🔌 Connected to Gemini API")
+# The SDK is imported and configured on the first completion (see rag.gemini_client)
+print("🔌 Gemini API key found")
 
 # Gemini model configuration
 GEMINI_MODEL = "models/gemini-2.5-flash"
@@ -45,17 +38,109 @@ GEMINI_CONFIG = {
     "top_k": 40
 }
 
-def generate_completion_with_context(prompt: str, max_contexts=3) -> str:
+# Completions want a short prompt: a smaller context budget than chat
+COMPLETION_CONTEXT_TOKENS = int(os.getenv("MCP_COMPLETION_CONTEXT_TOKENS", "1500"))
+# Inline completions are latency-bound, so they skip cross-encoder re-ranking unless asked
+COMPLETION_RERANK = os.getenv("MCP_COMPLETION_RERANK", "0").lower() not in ("0", "false", "no")
+
+# Seconds a request waits for its completion before giving up
+COMPLETION_TIMEOUT = float(os.getenv("MCP_COMPLETION_TIMEOUT", "30"))
+# Upper bounds (ms) of the completion latency histogram buckets exposed on GET /metrics
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class LatencyHistogram:
+    """Thread-safe latency histogram in milliseconds (per-bucket counts, not cumulative)."""
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, latency_ms: float):
+        index = next((i for i, bound in enumerate(self.buckets) if latency_ms <= bound), len(self.buckets))
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += latency_ms
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        count = sum(counts)
+        labels = [f"le_{bound}" for bound in self.buckets] + ["le_inf"]
+        return {
+            "count": count,
+            "sum_ms": round(total, 1),
+            "avg_ms": round(total / count, 1) if count else 0.0,
+            "buckets": dict(zip(labels, counts)),
+        }
+
+# Recent completions kept per client for serving the rest of a completion the user is typing out
+COMPLETION_CACHE_TTL = float(os.getenv("MCP_COMPLETION_CACHE_TTL", "300"))
+COMPLETION_CACHE_ENTRIES = int(os.getenv("MCP_COMPLETION_CACHE_ENTRIES", "8"))
+COMPLETION_CACHE_CLIENTS = 1024
+
+class CompletionCache:
+    """Per-client cache of recent (prompt, completion) pairs with prefix-aware lookup.
+
+    When the new prompt is an earlier prompt plus text that matches the start of the
+    completion returned for it, the user is typing that completion out, so the rest
+    of it is served without another retrieval or Gemini call. Entries are also keyed
+    by the retrieval filter, so a completion drawn from one project is never served
+    to a request filtered to another.
+    """
+    def __init__(self, ttl=COMPLETION_CACHE_TTL, entries_per_client=COMPLETION_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.entries_per_client = entries_per_client
+        self._clients = TTLCache(maxsize=COMPLETION_CACHE_CLIENTS, ttl=None)  # client id -> [(prompt, where, completion, expires_at)]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, client_id: str, prompt: str, where=None):
+        """Remaining completion text for this prompt and filter, or None on a miss."""
+        now = time.monotonic()
+        where_key = json.dumps(where, sort_keys=True)
+        with self._lock:
+            entries = [entry for entry in self._clients.get(client_id, []) if entry[3] > now]
+            for cached_prompt, cached_where, completion, _ in reversed(entries):
+                if cached_where != where_key or not prompt.startswith(cached_prompt):
+                    continue
+                typed = prompt[len(cached_prompt):]
+                if len(typed) < len(completion) and completion.startswith(typed):
+                    self.hits += 1
+                    return completion[len(typed):]
+            self.misses += 1
+            return None
+
+    def store(self, client_id: str, prompt: str, completion: str, where=None):
+        expires_at = time.monotonic() + self.ttl
+        where_key = json.dumps(where, sort_keys=True)
+        with self._lock:
+            entries = [entry for entry in self._clients.get(client_id, []) if entry[:2] != (prompt, where_key)]
+            entries.append((prompt, where_key, completion, expires_at))
+            self._clients.put(client_id, entries[-self.entries_per_client:])
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "clients": len(self._clients),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+async def generate_completion_with_context(prompt: str, max_contexts=3, where=None) -> str:
     """Generate completion using Gemini with RAG context"""
     try:
-        # Retrieve relevant context from ChromaDB
-        results = collection.query(
-            query_texts=[prompt],
-            n_results=max_contexts
+        # Retrieve relevant context from ChromaDB (blocking, so off the event loop)
+        loop = asyncio.get_running_loop()
+        context_docs, context_metas = await loop.run_in_executor(
+            None, engine.retrieve_context, prompt, max_contexts, where, COMPLETION_RERANK
         )
+        context_docs, _ = pack_context(context_docs, context_metas, token_budget=COMPLETION_CONTEXT_TOKENS)
         
-        # Extract documents and format context
-        context_docs = results['documents'][0] if results['documents'] else []
+        # Format context
         context = "\n\n".join([f"// Reference {i+1}:\n{doc}" for i, doc in enumerate(context_docs)])
         
         # Create the full prompt
@@ -70,12 +155,9 @@ def generate_completion_with_context(prompt: str, max_contexts=3) -> str:
         Return ONLY the completion code without explanations.
         """
         
-        # Call Gemini API
-        model = genai.GenerativeModel(GEMINI_MODEL)
-        response = model.generate_content(
-            full_prompt,
-            generation_config=genai.types.GenerationConfig(**GEMINI_CONFIG)
-        )
+        # Call Gemini API (model is built once and reused)
+        model = gemini_client.get_model(GEMINI_MODEL, GEMINI_CONFIG, api_key=GEMINI_API_KEY)
+        response = await model.generate_content_async(full_prompt)
         
         # Clean up Gemini response
         completion_text = response.text.strip()
@@ -91,18 +173,112 @@ def generate_completion_with_context(prompt: str, max_contexts=3) -> str:
         print(f"⚠️ Error generating completion: {e}")
         return ""
 
+class CompletionScheduler:
+    """Runs completions on one background event loop shared by all handler threads.
+
+    Identical prompts in flight at the same time share a single backend call, and
+    a new request from a client cancels that client's previous, now stale, request.
+    A shared backend call is only cancelled once nobody is waiting for it.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="completion-loop", daemon=True)
+        self._thread.start()
+        self._shared = {}  # (prompt, max_contexts, where) -> [task, waiters]; only touched on the loop
+        self._latest = {}  # client id -> future of its newest request
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "coalesced": 0, "superseded": 0, "timeouts": 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def complete(self, client_id: str, prompt: str, max_contexts: int = 3, where=None):
+        """Blocking call for handler threads. Returns None if a newer request superseded this one."""
+        future = asyncio.run_coroutine_threadsafe(self._complete(prompt, max_contexts, where), self.loop)
+        with self._lock:
+            self.stats["requests"] += 1
+            previous = self._latest.get(client_id)
+            self._latest[client_id] = future
+        if previous is not None:
+            previous.cancel()
+        try:
+            return future.result(timeout=COMPLETION_TIMEOUT)
+        except concurrent.futures.CancelledError:
+            self._count("superseded")
+            return None
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self._count("timeouts")
+            return ""
+        finally:
+            with self._lock:
+                if self._latest.get(client_id) is future:
+                    del self._latest[client_id]
+
+    def supersede(self, client_id: str):
+        """Cancel the client's in-flight request, e.g. because it was answered from cache."""
+        with self._lock:
+            previous = self._latest.pop(client_id, None)
+        if previous is not None:
+            previous.cancel()
+
+    async def _complete(self, prompt: str, max_contexts: int, where=None) -> str:
+        key = (prompt, max_contexts, json.dumps(where, sort_keys=True))
+        entry = self._shared.get(key)
+        if entry is None:
+            entry = [asyncio.ensure_future(generate_completion_with_context(prompt, max_contexts, where)), 0]
+            self._shared[key] = entry
+
+            def forget(_task, key=key, entry=entry):
+                if self._shared.get(key) is entry:
+                    del self._shared[key]
+            entry[0].add_done_callback(forget)
+        else:
+            self._count("coalesced")
+        entry[1] += 1
+        try:
+            # Shielded so one waiter being cancelled does not cancel the call for the others
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+scheduler = CompletionScheduler()
+completion_cache = CompletionCache()
+latency_histogram = LatencyHistogram()
+
 class MCPHandler(BaseHTTPRequestHandler):
     def _set_headers(self, status=200):
         self.send_response(status)
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Client-Id')
         self.end_headers()
     
     def do_OPTIONS(self):
         self._set_headers()
     
+    def do_GET(self):
+        if self.path == '/ready':
+            readiness = engine.readiness()
+            self._set_headers(200 if readiness["ready"] else 503)
+            self.wfile.write(json.dumps(readiness).encode())
+        elif self.path == '/metrics':
+            with scheduler._lock:
+                completions = dict(scheduler.stats)
+            self._set_headers()
+            self.wfile.write(json.dumps({
+                "completion_latency_ms": latency_histogram.snapshot(),
+                "completions": completions,
+                "completion_cache": completion_cache.stats()
+            }).encode())
+        else:
+            self._set_headers(404)
+            self.wfile.write(json.dumps({"error": "Endpoint not found"}).encode())
+    
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
@@ -133,7 +309,9 @@ class MCPHandler(BaseHTTPRequestHandler):
                 "capabilities": {
                     "completions": True,
                     "completionsInline": True,
-                    "dynamicRegistration": True
+                    "dynamicRegistration": True,
+                    # False while the embedder/collection are still warming up
+                    "retrievalReady": engine.ready
                 }
             }
         }
@@ -154,8 +332,28 @@ class MCPHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({"completions": []}).encode())
             return
         
-        # Generate completion with RAG context
-        completion_text = generate_completion_with_context(prompt)
+        # Requests from the same client supersede each other; fall back to the peer address
+        client_id = str(data.get('clientId') or self.headers.get('X-Client-Id') or self.client_address[0])
+        
+        # Serve the rest of a recent completion the user is typing out; otherwise
+        # generate a new one with RAG context
+        # Completions only draw on Motoko sources, optionally from one project
+        where = build_where(project=data.get('project'), file_type='motoko')
+        completion_text = completion_cache.lookup(client_id, prompt, where)
+        if completion_text is not None:
+            scheduler.supersede(client_id)
+        else:
+            completion_text = scheduler.complete(client_id, prompt, where=where)
+            if completion_text:
+                completion_cache.store(client_id, prompt, completion_text, where)
+        
+        if completion_text is None:
+            # A newer request from this client replaced this one
+            self._set_headers()
+            self.wfile.write(json.dumps({"completions": []}).encode())
+            return
+        
+        latency_histogram.observe((time.time() - start_time) * 1000)
         
         if not completion_text:
             self._set_headers()
@@ -184,12 +382,16 @@ class MCPHandler(BaseHTTPRequestHandler):
         return f"uuid-{int(time.time() * 1000)}"
 
 def run_server(port=9000):
-    server = HTTPServer(('localhost', port), MCPHandler)
+    # One thread per connection; completions themselves run on the scheduler's event loop
+    server = ThreadingHTTPServer(('localhost', port), MCPHandler)
+    engine.start_warm_up()
     print(f"\n⚡ MCP Server running on http://localhost:{port}")
     print("🚀 Ready for Copilot integration")
     print("🔧 Endpoints:")
     print(f"  - POST /v1/initialize")
     print(f"  - POST /v1/completions")
+    print(f"  - GET  /metrics")
+    print(f"  - GET  /ready")
     server.serve_forever()
 
 if __name__ == '__main__':
@@ -1,10 +1,25 @@
 import json
+import os
+
+from rag.context_packer import estimate_tokens
+
+# Prompt budget for past turns; older turns are folded into the rolling summary
+HISTORY_TOKEN_BUDGET = int(os.getenv("CONVERSATION_HISTORY_TOKEN_BUDGET", "2000"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("CONVERSATION_SUMMARY_TOKEN_BUDGET", "500"))
+# Folded user messages are shortened to this many characters
+FOLDED_MESSAGE_CHARS = 200
+
 class Conversation:
-    def __init__(self, history=None, new_message="", convo_id=None, user_id=None):
+    def __init__(self, history=None, new_message="", convo_id=None, user_id=None, summary="", first_seq=0):
         self.history = history if history else []
         self.new_message = new_message
         self.id =convo_id
         self.user_id = user_id if user_id else None
+        # Rolling summary of turns that no longer fit in the history window
+        self.summary = summary or ""
+        # Storage position of history[0] and how many history entries are already stored
+        self.first_seq = first_seq
+        self.saved_turns = len(self.history)
 
     def add_turn(self, role, content):
         self.history.append((role, content))
@@ -16,8 +31,42 @@ class Conversation:
         self.user_id = user_id
     def __repr__(self):
         return f"Conversation(history={self.history}, new_message='{self.new_message}')"
+
+    def compact_history(self, token_budget=HISTORY_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET):
+        """Fold the oldest turns into the rolling summary until the history fits the budget.
+
+        Assistant turns are already the summaries the model writes after the
+        separator, so folding is a plain concatenation with no extra LLM call.
+        The most recent user/assistant pair is always kept verbatim.
+        """
+        tokens = sum(estimate_tokens(text) for _, text in self.history)
+        folded = []
+        while tokens > token_budget and len(self.history) > 2:
+            role, text = self.history.pop(0)
+            self.first_seq += 1
+            self.saved_turns = max(self.saved_turns - 1, 0)
+            tokens -= estimate_tokens(text)
+            if role == "user":
+                if len(text) > FOLDED_MESSAGE_CHARS:
+                    text = text[:FOLDED_MESSAGE_CHARS] + "..."
+                folded.append(f"User asked: {text}")
+            else:
+                folded.append(f"Answer summary: {text}")
+        if not folded:
+            return
+        lines = [line for line in self.summary.split("\n") if line] + folded
+        # Drop the oldest summary lines once the summary itself is over budget
+        while len(lines) > 1 and sum(estimate_tokens(line) for line in lines) > summary_budget:
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+
     def build_conversation_history(self):
         contents = []
+        if self.summary:
+            contents.append({
+                "role": "system",
+                "parts": [{"text": "Summary of the earlier discussion:\n" + self.summary}]
+            })
         for role, text in self.history:
             contents.append({
                 "role": role,
@@ -30,6 +79,14 @@ class Conversation:
             })
         return contents
 
+    def unsaved_turns(self):
+        """(seq, role, content) for the turns added since the conversation was loaded or saved."""
+        return [
+            (self.first_seq + index, role, content)
+            for index, (role, content) in enumerate(self.history)
+            if index >= self.saved_turns
+        ]
+
     def serialize_history(self):
         return json.dumps(self.history)
 
@@ -1,50 +1,101 @@
-import sqlite3
-
 from ..models import conversation
+from .. import database
 from .. import list_api_keys
 
+CONVERSATIONS_DB_PATH = 'conversations.db'
+# Safety cap on turns read per load; the history window is normally far smaller
+MAX_LOADED_TURNS = 200
+
 def init_schema():
-    conn = sqlite3.connect('conversations.db')
+    conn = database.get_connection(CONVERSATIONS_DB_PATH)
     cur = conn.cursor()
     cur.execute('''
     CREATE TABLE IF NOT EXISTS conversations (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     history TEXT  NOT NULL,
     new_message TEXT NOT NULL,
-    user_id INTEGER NOT NULL
+    user_id INTEGER NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    window_start INTEGER NOT NULL DEFAULT 0
     )
     ''')
+    # Turns are appended one row each instead of rewriting a JSON blob per turn
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_turns (
+    conversation_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+    ) WITHOUT ROWID
+    ''')
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(conversations)")]
+    if "summary" not in columns:
+        cur.execute("ALTER TABLE conversations ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+    if "window_start" not in columns:
+        cur.execute("ALTER TABLE conversations ADD COLUMN window_start INTEGER NOT NULL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id)")
     conn.commit()
-    conn.close()
+    _migrate_history_blobs(conn)
+
+def _migrate_history_blobs(conn):
+    """Move turns from the legacy history JSON column into conversation_turns."""
+    rows = conn.execute("SELECT id, history FROM conversations WHERE history != '[]'").fetchall()
+    if not rows:
+        return
+    with conn:
+        for convo_id, history_json in rows:
+            history = conversation.Conversation.deserialize_history(history_json)
+            conn.executemany(
+                "INSERT OR IGNORE INTO conversation_turns (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(convo_id, seq, role, content) for seq, (role, content) in enumerate(history)]
+            )
+            conn.execute("UPDATE conversations SET history = '[]', window_start = 0 WHERE id = ?", (convo_id,))
+    print(f"Migrated {len(rows)} conversations to conversation_turns")
 
 def save_conversation(convo: conversation.Conversation):
-    conn = sqlite3.connect('conversations.db')
-    cur = conn.cursor()
-    if convo.id is None:
-        cur.execute('''
-                    INSERT INTO conversations (history, new_message, user_id) VALUES (?, ?, ?)
-                    ''',
-                    (convo.serialize_history(), convo.new_message,list_api_keys.user_id))
-        convo.id = cur.lastrowid
-    else:
-        cur.execute('''
-                    UPDATE conversations SET history = ?, new_message = ?, user_id = ? WHERE id = ?
-                    ''',
-                    (convo.serialize_history(), convo.new_message, list_api_keys.user_id, convo.id))
-    conn.commit()
-    conn.close()
+    conn = database.get_connection(CONVERSATIONS_DB_PATH)
+    with conn:
+        cur = conn.cursor()
+        if convo.id is None:
+            cur.execute('''
+                        INSERT INTO conversations (history, new_message, user_id, summary, window_start) VALUES ('[]', ?, ?, ?, ?)
+                        ''',
+                        (convo.new_message,list_api_keys.user_id, convo.summary, convo.first_seq))
+            convo.id = cur.lastrowid
+        else:
+            cur.execute('''
+                        UPDATE conversations SET new_message = ?, user_id = ?, summary = ?, window_start = ? WHERE id = ?
+                        ''',
+                        (convo.new_message, list_api_keys.user_id, convo.summary, convo.first_seq, convo.id))
+        # Only the turns added since the last load/save are written. seq is assigned here,
+        # under the write lock, so concurrent requests on one conversation append in turn
+        # instead of colliding on the numbers they computed when they loaded it
+        cur.executemany('''
+                        INSERT INTO conversation_turns (conversation_id, seq, role, content)
+                        SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ? FROM conversation_turns WHERE conversation_id = ?
+                        ''',
+                        [(convo.id, role, content, convo.id) for _, role, content in convo.unsaved_turns()])
+    convo.saved_turns = len(convo.history)
 
-def load_conversation(convo_id: int) -> conversation.Conversation:
-    conn = sqlite3.connect('conversations.db')
+def load_conversation(convo_id: int, max_turns: int = MAX_LOADED_TURNS) -> conversation.Conversation:
+    """Load a conversation with the last max_turns turns of its current history window."""
+    conn = database.get_connection(CONVERSATIONS_DB_PATH)
     cur = conn.cursor()
     cur.execute('''
-                SELECT id, history, new_message, user_id FROM conversations WHERE id = ?
+                SELECT id, new_message, user_id, summary, window_start FROM conversations WHERE id = ?
                 ''', (convo_id,))
     row = cur.fetchone()
-    conn.close()
 
     if row:
-        convo_id, history_json, new_message, user_id = row
-        history = conversation.Conversation.deserialize_history(history_json)
-        return conversation.Conversation(history=history, new_message=new_message, convo_id=convo_id, user_id=user_id)
-    return None
\ No newline at end of file
+        convo_id, new_message, user_id, summary, window_start = row
+        cur.execute('''
+                    SELECT seq, role, content FROM conversation_turns
+                    WHERE conversation_id = ? AND seq >= ? ORDER BY seq DESC LIMIT ?
+                    ''', (convo_id, window_start, max_turns))
+        turns = cur.fetchall()[::-1]
+        history = [(role, content) for _, role, content in turns]
+        first_seq = turns[0][0] if turns else window_start
+        return conversation.Conversation(history=history, new_message=new_message, convo_id=convo_id,
+                                         user_id=user_id, summary=summary, first_seq=first_seq)
+    return None
@@ -0,0 +1,66 @@
+"""
+Short-lived signed session tokens for the auth server.
+
+/login runs the password KDF once and hands out a token; later requests only
+verify an HMAC signature and an expiry, with no database access. Tokens are
+stateless, so they stay valid until they expire even if the user logs out.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from typing import Any, Dict, Optional
+
+SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", "3600"))
+
+_secret = None
+
+
+def _signing_secret() -> bytes:
+    """SESSION_SECRET, or a random per-process secret when it is not set."""
+    global _secret
+    if _secret is None:
+        configured = os.getenv("SESSION_SECRET")
+        if configured:
+            _secret = configured.encode()
+        else:
+            print("SESSION_SECRET not set; session tokens will not survive a restart or work across workers")
+            _secret = secrets.token_bytes(32)
+    return _secret
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_signing_secret(), payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(user_id: int, username: str, ttl: int = SESSION_TOKEN_TTL) -> str:
+    """Signed token of the form <base64 payload>.<base64 signature>."""
+    claims = {"sub": user_id, "name": username, "exp": int(time.time()) + ttl}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str) -> Optional[Dict[str, Any]]:
+    """Return the token's claims, or None if it is malformed, forged or expired."""
+    try:
+        payload, signature = token.split(".", 1)
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if claims.get("exp", 0) <= time.time():
+        return None
+    return claims
@@ -8,50 +8,78 @@ import os
 import json
 import sys
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Optional
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from dotenv import load_dotenv
+from rag.retrieval import get_engine, format_context_result, build_where, MAX_BATCH_QUERIES
+from rag.context_packer import pack_context
+from rag import gemini_client
 
-# Try to import Gemini
-try:
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
-except ImportError:
-    GEMINI_AVAILABLE = False
+GEMINI_AVAILABLE = gemini_client.GEMINI_SDK_AVAILABLE
+if not GEMINI_AVAILABLE:
     print("⚠️  Gemini SDK not available. Install with: pip install google-generativeai", file=sys.stderr)
 
 # Load environment variables
 load_dotenv()
 
-# ChromaDB Setup - using relative path from API directory
-CHROMA_DIR = "chromadb_data"
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-embedding_fn = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+# Shared retrieval engine (ChromaDB collection + embedder), loaded lazily;
+# run() starts a background warm-up so the initialize handshake is answered immediately
+engine = get_engine()
 
 # Gemini setup
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_AVAILABLE and GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel("models/gemini-2.0-flash-exp")
-    print(f"✅ Gemini model loaded: gemini-2.0-flash-exp", file=sys.stderr)
+GEMINI_MODEL = "models/gemini-2.0-flash-exp"
+GEMINI_CONFIGURED = GEMINI_AVAILABLE and bool(GEMINI_API_KEY)
+if GEMINI_CONFIGURED:
+    print(f"✅ Gemini configured: gemini-2.0-flash-exp", file=sys.stderr)
 else:
-    gemini_model = None
     print("⚠️  Gemini not configured. Set GEMINI_API_KEY environment variable.", file=sys.stderr)
 
-try:
-    collection = chroma_client.get_collection(
-        name="motoko_code_samples", 
-        embedding_function=embedding_fn
+def get_gemini_model():
+    """Shared Gemini model, or None if Gemini is not configured (the SDK is imported on first call)"""
+    if not GEMINI_CONFIGURED:
+        return None
+    return gemini_client.get_model(GEMINI_MODEL, api_key=GEMINI_API_KEY)
+
+# Optional retrieval filters shared by every tool that searches the samples
+FILTER_PROPERTIES = {
+    "project": {
+        "type": "string",
+        "description": "Only use samples from this project (top-level directory of motoko_code_samples)"
+    },
+    "file_type": {
+        "type": "string",
+        "enum": ["motoko", "toml"],
+        "description": "Only use Motoko sources (motoko) or mops.toml files (toml)"
+    },
+    "has_toml": {
+        "type": "boolean",
+        "description": "Only use files whose directory does (true) or does not (false) contain a mops.toml"
+    }
+}
+
+# Retrieval option shared by the context and generation tools
+RERANK_PROPERTY = {
+    "rerank": {
+        "type": "boolean",
+        "description": "Re-rank candidates with a local cross-encoder (default: server setting RAG_RERANK)"
+    }
+}
+
+def where_from_arguments(arguments: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """ChromaDB where filter from a tool call's filter arguments"""
+    return build_where(
+        project=arguments.get("project"),
+        file_type=arguments.get("file_type"),
+        has_toml=arguments.get("has_toml")
     )
-    print(f"✅ ChromaDB collection loaded with {collection.count()} Motoko samples", file=sys.stderr)
-except Exception as e:
-    print(f"❌ Error accessing ChromaDB collection: {e}", file=sys.stderr)
-    print("💡 Make sure to run the ingestion script first: python ingest/motoko_samples_ingester.py", file=sys.stderr)
-    sys.exit(1)
 
 class MCPServer:
     def __init__(self):
+        # Requests are handled as concurrent tasks; responses may go out in any order
+        self._write_lock = None
+        self._in_flight: Dict[Any, asyncio.Task] = {}
         self.tools = {
             "get_motoko_context": {
                 "name": "get_motoko_context",
@@ -67,11 +95,35 @@ class MCPServer:
                             "type": "integer",
                             "description": "Maximum number of context results to return (default: 5)",
                             "default": 5
-                        }
+                        },
+                        **FILTER_PROPERTIES,
+                        **RERANK_PROPERTY
                     },
                     "required": ["query"]
                 }
             },
+            "get_motoko_context_batch": {
+                "name": "get_motoko_context_batch",
+                "description": "Retrieve relevant Motoko code context for several queries in one call",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "queries": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": f"Queries to search for relevant Motoko examples (at most {MAX_BATCH_QUERIES})"
+                        },
+                        "max_results": {
+                            "type": "integer",
+                            "description": "Maximum number of context results per query (default: 5)",
+                            "default": 5
+                        },
+                        **FILTER_PROPERTIES,
+                        **RERANK_PROPERTY
+                    },
+                    "required": ["queries"]
+                }
+            },
             "generate_motoko_code": {
                 "name": "generate_motoko_code",
                 "description": "Generate Motoko code using Gemini with RAG context retrieval",
@@ -86,14 +138,16 @@ class MCPServer:
                             "type": "integer",
                             "description": "Maximum number of context results to retrieve (default: 5)",
                             "default": 5
-                        }
+                        },
+                        **FILTER_PROPERTIES,
+                        **RERANK_PROPERTY
                     },
                     "required": ["query"]
                 }
             }
         }
     
-    def send_response(self, id: str, result: Any = None, error: Any = None):
+    async def send_response(self, id: str, result: Any = None, error: Any = None):
         """Send a JSON-RPC response"""
         response = {
             "jsonrpc": "2.0",
@@ -105,15 +159,21 @@ class MCPServer:
         else:
             response["result"] = result
         
-        print(json.dumps(response))
-        sys.stdout.flush()
+        # One whole line per response, even with several handlers finishing at once
+        async with self._write_lock:
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
     
-    def handle_initialize(self, request_id: str, params: Dict[str, Any]):
+    async def handle_initialize(self, request_id: str, params: Dict[str, Any]):
         """Handle MCP initialize request"""
         result = {
             "protocolVersion": "2024-11-05",
             "capabilities": {
-                "tools": {}
+                "tools": {},
+                # Tools work either way; until ready, the first call also loads the embedder
+                "experimental": {
+                    "motokoCoder": engine.readiness()
+                }
             },
             "serverInfo": {
                 "name": "motoko-coder-mcp",
@@ -121,49 +181,64 @@ class MCPServer:
                 "description": "MCP server for Motoko code generation with RAG context retrieval"
             }
         }
-        self.send_response(request_id, result)
+        await self.send_response(request_id, result)
     
-    def handle_tools_list(self, request_id: str):
+    async def handle_tools_list(self, request_id: str):
         """Handle tools/list request"""
         tools_list = list(self.tools.values())
-        self.send_response(request_id, {"tools": tools_list})
+        await self.send_response(request_id, {"tools": tools_list})
     
-    def retrieve_motoko_context(self, query: str, max_results: int = 5) -> List[Dict[str, Any]]:
+    def retrieve_motoko_context(self, query: str, max_results: int = 5, where: Optional[Dict[str, Any]] = None,
+                                rerank: Optional[bool] = None) -> List[Dict[str, Any]]:
         """Retrieve relevant Motoko code context using RAG"""
         try:
-            # Generate query embedding
-            query_emb = embedding_fn([query])[0]
-            
             # Search for relevant documents
-            results = collection.query(
-                query_embeddings=[query_emb],
-                n_results=max_results
-            )
-            
-            docs = results.get("documents", [[]])[0]
-            metadatas = results.get("metadatas", [[]])[0]
-            
-            # Format context results
-            context_results = []
-            for i, (doc, meta) in enumerate(zip(docs, metadatas)):
-                context_result = {
-                    "index": i + 1,
-                    "filename": meta.get("filename", "unknown"),
-                    "project": meta.get("folders", "unknown"),
-                    "file_type": meta.get("file_type", "unknown"),
-                    "has_toml": meta.get("has_toml", False),
-                    "content": doc[:2000] + "..." if len(doc) > 2000 else doc,
-                    "full_path": meta.get("rel_path", "unknown")
-                }
-                context_results.append(context_result)
+            docs, metadatas = engine.retrieve_context(query, max_results, where, rerank)
             
-            return context_results
+            # Deduplicate and fit the token budget, cutting only at declaration boundaries
+            docs, metadatas = pack_context(docs, metadatas)
+            return [
+                format_context_result(i + 1, doc, meta)
+                for i, (doc, meta) in enumerate(zip(docs, metadatas))
+            ]
         except Exception as e:
             print(f"❌ Error retrieving context: {e}", file=sys.stderr)
             return []
     
-    def generate_code_with_gemini(self, query: str, context_results: List[Dict[str, Any]]) -> str:
+    def retrieve_motoko_context_batch(self, queries: List[str], max_results: int = 5,
+                                      where: Optional[Dict[str, Any]] = None,
+                                      rerank: Optional[bool] = None) -> List[List[Dict[str, Any]]]:
+        """Retrieve context for several queries with one embedding call and one collection query"""
+        try:
+            return [
+                [
+                    format_context_result(i + 1, doc, meta)
+                    for i, (doc, meta) in enumerate(zip(*pack_context(docs, metadatas)))
+                ]
+                for docs, metadatas in engine.retrieve_many(queries, max_results, where, rerank)
+            ]
+        except Exception as e:
+            print(f"❌ Error retrieving context: {e}", file=sys.stderr)
+            return [[] for _ in queries]
+    
+    def format_context_text(self, query: str, context_results: List[Dict[str, Any]]) -> str:
+        """Format retrieved context as markdown for Cursor"""
+        formatted_context = f"Retrieved {len(context_results)} relevant Motoko code samples for: '{query}'\n\n"
+        for ctx in context_results:
+            formatted_context += f"**{ctx['filename']}** ({ctx['project']}):\n```motoko\n{ctx['content']}\n```\n\n"
+        return formatted_context.strip()
+    
+    async def retrieve_motoko_context_async(self, query: str, max_results: int = 5,
+                                            where: Optional[Dict[str, Any]] = None,
+                                            rerank: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """retrieve_motoko_context on a worker thread, keeping the loop free for other requests"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.retrieve_motoko_context, query, max_results, where, rerank)
+    
+    async def generate_code_with_gemini(self, query: str, context_results: List[Dict[str, Any]]) -> str:
         """Generate Motoko code using Gemini with RAG context"""
+        # First call imports the SDK, so keep it off the event loop
+        gemini_model = await asyncio.get_running_loop().run_in_executor(None, get_gemini_model)
         if not gemini_model:
             return "❌ Gemini is not configured. Please set the GEMINI_API_KEY environment variable."
         
@@ -191,15 +266,15 @@ Please provide:
 
 Focus on writing idiomatic Motoko code that follows best practices."""
 
-            # Generate response with Gemini
-            response = gemini_model.generate_content(prompt)
+            # Generate response with Gemini (async, so a cancelled request stops waiting on it)
+            response = await gemini_model.generate_content_async(prompt)
             return response.text
             
         except Exception as e:
             print(f"❌ Error generating code with Gemini: {e}", file=sys.stderr)
             return f"❌ Error generating code: {str(e)}"
     
-    def handle_tools_call(self, request_id: str, params: Dict[str, Any]):
+    async def handle_tools_call(self, request_id: str, params: Dict[str, Any]):
         """Handle tools/call request"""
         tool_name = params.get("name")
         arguments = params.get("arguments", {})
@@ -210,34 +285,71 @@ Focus on writing idiomatic Motoko code that follows best practices."""
                 max_results = arguments.get("max_results", 5)
                 
                 if not query:
-                    self.send_response(request_id, error={
+                    await self.send_response(request_id, error={
                         "code": -32602,
                         "message": "Query parameter is required"
                     })
                     return
                 
                 # Retrieve context
-                context_results = self.retrieve_motoko_context(query, max_results)
+                context_results = await self.retrieve_motoko_context_async(
+                    query, max_results, where_from_arguments(arguments), arguments.get("rerank")
+                )
                 
                 # Format response for Cursor
-                formatted_context = f"Retrieved {len(context_results)} relevant Motoko code samples for: '{query}'\n\n"
-                for ctx in context_results:
-                    formatted_context += f"**{ctx['filename']}** ({ctx['project']}):\n```motoko\n{ctx['content']}\n```\n\n"
-                
                 result = {
                     "content": [
                         {
                             "type": "text",
-                            "text": formatted_context.strip()
+                            "text": self.format_context_text(query, context_results)
                         }
                     ]
                 }
                 
-                self.send_response(request_id, result)
+                await self.send_response(request_id, result)
                 
             except Exception as e:
                 print(f"❌ Error in get_motoko_context: {e}", file=sys.stderr)
-                self.send_response(request_id, error={
+                await self.send_response(request_id, error={
+                    "code": -32603,
+                    "message": f"Internal error: {str(e)}"
+                })
+        
+        elif tool_name == "get_motoko_context_batch":
+            try:
+                queries = [query for query in arguments.get("queries", []) if query]
+                max_results = arguments.get("max_results", 5)
+                
+                if not queries or len(queries) > MAX_BATCH_QUERIES:
+                    await self.send_response(request_id, error={
+                        "code": -32602,
+                        "message": f"Between 1 and {MAX_BATCH_QUERIES} queries are required"
+                    })
+                    return
+                
+                # One embedding call and one collection query for the whole batch
+                loop = asyncio.get_running_loop()
+                batch_results = await loop.run_in_executor(
+                    None, self.retrieve_motoko_context_batch, queries, max_results,
+                    where_from_arguments(arguments), arguments.get("rerank")
+                )
+                
+                # One text block per query, in request order
+                result = {
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": self.format_context_text(query, context_results)
+                        }
+                        for query, context_results in zip(queries, batch_results)
+                    ]
+                }
+                
+                await self.send_response(request_id, result)
+                
+            except Exception as e:
+                print(f"❌ Error in get_motoko_context_batch: {e}", file=sys.stderr)
+                await self.send_response(request_id, error={
                     "code": -32603,
                     "message": f"Internal error: {str(e)}"
                 })
@@ -248,17 +360,19 @@ Focus on writing idiomatic Motoko code that follows best practices."""
                 max_context_results = arguments.get("max_context_results", 5)
                 
                 if not query:
-                    self.send_response(request_id, error={
+                    await self.send_response(request_id, error={
                         "code": -32602,
                         "message": "Query parameter is required"
                     })
                     return
                 
                 # Retrieve context first
-                context_results = self.retrieve_motoko_context(query, max_context_results)
+                context_results = await self.retrieve_motoko_context_async(
+                    query, max_context_results, where_from_arguments(arguments), arguments.get("rerank")
+                )
                 
                 # Generate code with Gemini
-                generated_code = self.generate_code_with_gemini(query, context_results)
+                generated_code = await self.generate_code_with_gemini(query, context_results)
                 
                 result = {
                     "content": [
@@ -269,17 +383,17 @@ Focus on writing idiomatic Motoko code that follows best practices."""
                     ]
                 }
                 
-                self.send_response(request_id, result)
+                await self.send_response(request_id, result)
                 
             except Exception as e:
                 print(f"❌ Error in generate_motoko_code: {e}", file=sys.stderr)
-                self.send_response(request_id, error={
+                await self.send_response(request_id, error={
                     "code": -32603,
                     "message": f"Internal error: {str(e)}"
                 })
         
         else:
-            self.send_response(request_id, error={
+            await self.send_response(request_id, error={
                 "code": -32601,
                 "message": f"Method '{tool_name}' not found"
             })
@@ -288,19 +402,48 @@ Focus on writing idiomatic Motoko code that follows best practices."""
         """Handle notifications (no response needed)"""
         if method == "notifications/initialized":
             print(f"🎉 MCP Server initialized successfully", file=sys.stderr)
+        elif method == "notifications/cancelled":
+            # The client no longer wants this result; per MCP no response is sent for it
+            task = self._in_flight.get(params.get("requestId"))
+            if task is not None:
+                print(f"🛑 Cancelling request {params.get('requestId')}: {params.get('reason', 'no reason given')}", file=sys.stderr)
+                task.cancel()
     
-    def run(self):
-        """Main server loop - reads from stdin, writes to stdout"""
-        print("🚀 Motoko Coder MCP Server starting...", file=sys.stderr)
-        print(f"📚 ChromaDB: {collection.count()} Motoko samples available", file=sys.stderr)
-        if gemini_model:
-            print(f"🤖 Gemini: Ready for code generation", file=sys.stderr)
-        else:
-            print(f"⚠️  Gemini: Not configured", file=sys.stderr)
+    async def handle_request(self, request_id: Any, method: str, params: Dict[str, Any]):
+        """Dispatch one JSON-RPC request; runs as its own task"""
+        try:
+            if method == "initialize":
+                await self.handle_initialize(request_id, params)
+            elif method == "tools/list":
+                await self.handle_tools_list(request_id)
+            elif method == "tools/call":
+                await self.handle_tools_call(request_id, params)
+            else:
+                if request_id:
+                    await self.send_response(request_id, error={
+                        "code": -32601,
+                        "message": f"Method '{method}' not found"
+                    })
+        except asyncio.CancelledError:
+            print(f"🛑 Request {request_id} cancelled", file=sys.stderr)
+        except Exception as e:
+            print(f"❌ Error: {e}", file=sys.stderr)
+        finally:
+            self._in_flight.pop(request_id, None)
+    
+    async def serve(self):
+        """Main server loop - reads from stdin, dispatches each request concurrently"""
+        self._write_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        # stdin is read on its own thread, which works for pipes, files and terminals alike
+        reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mcp-stdin")
         
         while True:
             try:
-                line = input()
+                line = await loop.run_in_executor(reader, sys.stdin.readline)
+                if not line:
+                    print("👋 Client disconnected", file=sys.stderr)
+                    break
                 if not line.strip():
                     continue
                 
@@ -311,31 +454,37 @@ Focus on writing idiomatic Motoko code that follows best practices."""
                 
                 print(f"📨 Received: {method}", file=sys.stderr)
                 
-                if method == "initialize":
-                    self.handle_initialize(request_id, params)
-                elif method == "tools/list":
-                    self.handle_tools_list(request_id)
-                elif method == "tools/call":
-                    self.handle_tools_call(request_id, params)
-                elif method.startswith("notifications/"):
+                if method.startswith("notifications/"):
                     self.handle_notification(method, params)
                 else:
-                    if request_id:
-                        self.send_response(request_id, error={
-                            "code": -32601,
-                            "message": f"Method '{method}' not found"
-                        })
+                    task = asyncio.create_task(self.handle_request(request_id, method, params))
+                    if request_id is not None:
+                        self._in_flight[request_id] = task
                 
-            except EOFError:
-                print("👋 Client disconnected", file=sys.stderr)
-                break
             except json.JSONDecodeError as e:
                 print(f"❌ Invalid JSON: {e}", file=sys.stderr)
                 continue
             except Exception as e:
                 print(f"❌ Error: {e}", file=sys.stderr)
                 continue
+        
+        # Let requests that were already received finish before exiting
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight.values(), return_exceptions=True)
+        reader.shutdown(wait=False)
+    
+    def run(self):
+        """Start the server and run the asyncio loop until stdin closes"""
+        print("🚀 Motoko Coder MCP Server starting...", file=sys.stderr)
+        # Warm up in the background; readiness is logged once the embedder and collection are loaded
+        engine.start_warm_up()
+        if GEMINI_CONFIGURED:
+            print(f"🤖 Gemini: Ready for code generation", file=sys.stderr)
+        else:
+            print(f"⚠️  Gemini: Not configured", file=sys.stderr)
+        
+        asyncio.run(self.serve())
 
 if __name__ == "__main__":
     server = MCPServer()
-    server.run()
\ No newline at end of file
+    server.run()
@@ -0,0 +1,155 @@
+"""
+Syntax-aware chunking of Motoko sources.
+
+all-MiniLM-L6-v2 only looks at the first 256 word pieces of its input, so whole
+files are split at declaration boundaries (actor / module / class / object / func /
+type) before embedding. Boundaries are only taken at the top level or directly
+inside an actor/module/class body, so nested helper functions stay with their parent.
+
+Chunks are measured with the embedder's tokenizer when one is given (the ingester
+does), overlap included. Without one, a character budget is used instead.
+"""
+
+import re
+
+# all-MiniLM-L6-v2's max_seq_length (256) less the [CLS] and [SEP] tokens
+DEFAULT_MAX_TOKENS = 254
+# Character fallback: on the sample corpus code takes as little as ~2.8 characters
+# per pre-token (before word-piece splitting), so 500 characters keeps well under 254
+DEFAULT_MAX_CHARS = 500
+# Lines of the previous chunk repeated at the top of the next one
+DEFAULT_OVERLAP_LINES = 2
+# Brace depth up to which a declaration starts a new chunk
+MAX_BOUNDARY_DEPTH = 1
+
+DECLARATION_RE = re.compile(
+    r"^\s*(?:(?:public|private|system|shared(?:\s*\([^)]*\))?|query|composite|"
+    r"persistent|transient|stable|flexible|async)\s+)*"
+    r"(?:actor|module|class|object|func|type)\b"
+)
+COMMENT_RE = re.compile(r"^\s*(?://|/\*|\*)")
+STRING_RE = re.compile(r'"(?:\\.|[^"\\])*"')
+
+
+def _line_depths(lines):
+    """Brace depth at the start of every line, ignoring strings and comments."""
+    depths = []
+    depth = 0
+    in_block_comment = False
+    for line in lines:
+        depths.append(depth)
+        text = STRING_RE.sub('""', line)
+        i = 0
+        while i < len(text):
+            if in_block_comment:
+                end = text.find("*/", i)
+                if end == -1:
+                    break
+                in_block_comment = False
+                i = end + 2
+                continue
+            if text.startswith("//", i):
+                break
+            if text.startswith("/*", i):
+                in_block_comment = True
+                i += 2
+                continue
+            if text[i] == "{":
+                depth += 1
+            elif text[i] == "}":
+                depth = max(depth - 1, 0)
+            i += 1
+    return depths
+
+
+def _boundaries(lines):
+    """Indices of lines that start a new declaration, including its leading comments."""
+    depths = _line_depths(lines)
+    starts = [0]
+    for idx, line in enumerate(lines):
+        if idx == 0 or depths[idx] > MAX_BOUNDARY_DEPTH or not DECLARATION_RE.match(line):
+            continue
+        # Keep doc comments attached to the declaration they describe
+        start = idx
+        while start > starts[-1] + 1 and COMMENT_RE.match(lines[start - 1]):
+            start -= 1
+        if start > starts[-1]:
+            starts.append(start)
+    return starts
+
+
+def _split_long(start, end, sizes, max_size):
+    """Split lines[start:end] into line windows of at most max_size (a single line may exceed it)."""
+    pieces = []
+    piece_start = start
+    size = 0
+    for idx in range(start, end):
+        line_size = sizes[idx]
+        if size and size + line_size > max_size:
+            pieces.append((piece_start, idx))
+            piece_start, size = idx, 0
+        size += line_size
+    pieces.append((piece_start, end))
+    return pieces
+
+
+def chunk_motoko_source(source, max_chars=DEFAULT_MAX_CHARS, overlap_lines=DEFAULT_OVERLAP_LINES,
+                        count_tokens=None, max_tokens=DEFAULT_MAX_TOKENS):
+    """Split Motoko source into chunks of at most max_tokens tokens, or max_chars characters.
+
+    count_tokens(lines) -> per-line token counts selects the token budget; without
+    it chunks are limited to max_chars characters. Returns a list of {"text",
+    "start_line", "end_line"} dicts with 1-based, inclusive line numbers. Small
+    neighbouring declarations are merged, oversized ones are split by lines, and
+    every chunk after the first repeats up to overlap_lines lines of its
+    predecessor, as far as they fit the budget. Only a single line longer than the
+    budget can produce an oversized chunk.
+    """
+    lines = source.splitlines()
+    if not lines:
+        return []
+    # Word pieces never span a line break, so per-line counts add up to the chunk's count
+    if count_tokens is not None:
+        sizes, max_size = list(count_tokens(lines)), max_tokens
+    else:
+        sizes, max_size = [len(line) + 1 for line in lines], max_chars
+    if sum(sizes) <= max_size:
+        return [{"text": source, "start_line": 1, "end_line": len(lines)}]
+
+    starts = _boundaries(lines) + [len(lines)]
+    segments = []
+    for seg_start, seg_end in zip(starts, starts[1:]):
+        segments.extend(_split_long(seg_start, seg_end, sizes, max_size))
+
+    # Merge neighbouring segments while they fit in one chunk
+    spans = []
+    for seg_start, seg_end in segments:
+        seg_size = sum(sizes[seg_start:seg_end])
+        if spans and spans[-1][2] + seg_size <= max_size:
+            spans[-1] = (spans[-1][0], seg_end, spans[-1][2] + seg_size)
+        else:
+            spans.append((seg_start, seg_end, seg_size))
+
+    chunks = []
+    for idx, (span_start, span_end, span_size) in enumerate(spans):
+        if idx > 0:
+            # Overlap counts against the budget: repeat only the lines that still fit
+            floor = max(span_start - overlap_lines, 0)
+            while span_start > floor and span_size + sizes[span_start - 1] <= max_size:
+                span_start -= 1
+                span_size += sizes[span_start]
+        chunks.append({
+            "text": "\n".join(lines[span_start:span_end]),
+            "start_line": span_start + 1,
+            "end_line": span_end,
+        })
+    return chunks
+
+
+def chunk_document(text, file_type, max_chars=DEFAULT_MAX_CHARS, overlap_lines=DEFAULT_OVERLAP_LINES,
+                   count_tokens=None, max_tokens=DEFAULT_MAX_TOKENS):
+    """Chunk a document by type: Motoko sources are split, mops.toml files stay whole."""
+    if file_type == "motoko":
+        return chunk_motoko_source(text, max_chars=max_chars, overlap_lines=overlap_lines,
+                                   count_tokens=count_tokens, max_tokens=max_tokens)
+    return [{"text": text, "start_line": 1, "end_line": max(len(text.splitlines()), 1)}]
@@ -1,18 +1,69 @@
 import os
+import json
+import time
+import hashlib
+import argparse
 from sentence_transformers import SentenceTransformer
 import chromadb
 from chromadb.config import Settings
 from tqdm import tqdm  # Add tqdm for progress bar
+from ingest.motoko_chunker import chunk_document
+from rag.retrieval import bump_generation, save_project_index
+from rag.lexical_index import LexicalIndex
 
 # Directory containing .mo files
 SAMPLES_DIR = "motoko_code_samples"
 
+# Manifest of already ingested files, kept next to the ChromaDB data
+MANIFEST_FILENAME = "ingest_manifest.json"
+# Bump when the document layout (IDs, chunking) changes so old manifests trigger a rebuild
+MANIFEST_VERSION = 4
+
+# Batching defaults for the embedding step
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_WORKERS = 0  # 0 = encode in this process, >1 = spread over a process pool
+# Chunks embedded and written to ChromaDB per committed batch
+DEFAULT_WRITE_BATCH_SIZE = 256
+
 # Load the local embedding model once
 model = SentenceTransformer('all-MiniLM-L6-v2')
 
+# Chunks are sized in the embedder's own word pieces so none is cut off at max_seq_length
+MAX_CHUNK_TOKENS = model.max_seq_length - 2  # [CLS] and [SEP]
+
+def count_tokens(lines):
+    """Word pieces per line, as the embedding model's tokenizer splits them."""
+    encoded = model.tokenizer(lines, add_special_tokens=False, verbose=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
 def get_embedding(text: str) -> list:
     return model.encode(text).tolist()
 
+def get_embeddings(texts, batch_size=DEFAULT_BATCH_SIZE, pool=None):
+    """Embed many documents at once.
+
+    Documents are sorted by length before encoding so every batch holds texts of
+    similar size (less padding per batch), then restored to the input order.
+    When a SentenceTransformer process pool is given the batches are spread over it.
+    """
+    if not texts:
+        return []
+    order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+    sorted_texts = [texts[idx] for idx in order]
+    if pool is not None:
+        vectors = model.encode_multi_process(sorted_texts, pool, batch_size=batch_size)
+    else:
+        vectors = model.encode(sorted_texts, batch_size=batch_size)
+    embeddings = [None] * len(texts)
+    for position, idx in enumerate(order):
+        embeddings[idx] = vectors[position].tolist()
+    return embeddings
+
+def project_of(rel_path):
+    """Top-level sample directory a file belongs to ("" for files at the root)."""
+    parts = rel_path.split(os.sep)
+    return parts[0] if len(parts) > 1 else ""
+
 def get_metadata(file_path, base_dir, has_toml=False):
     rel_path = os.path.relpath(file_path, base_dir)
     parts = rel_path.split(os.sep)
@@ -20,6 +71,7 @@ def get_metadata(file_path, base_dir, has_toml=False):
     filename = parts[-1]
     metadata = {
         "folders": "/".join(folders),  # Convert list to string
+        "project": project_of(rel_path),
         "filename": filename,
         "rel_path": rel_path,
         "file_type": "motoko" if filename.endswith(".mo") else "toml"
@@ -28,71 +80,245 @@ def get_metadata(file_path, base_dir, has_toml=False):
     metadata["has_toml"] = has_toml
     return metadata
 
-def find_project_files(samples_dir):
-    """Find all .mo files and mops.toml files in the samples directory."""
-    mo_files = []
-    mops_toml_files = []
-    project_toml_map = {}  # Map project directories to their mops.toml file
+def iter_project_files(samples_dir):
+    """Yield (file_path, has_toml) for every .mo and mops.toml file, one directory at a time."""
     for root, _, files in os.walk(samples_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
+        # A .mo file is flagged when its own directory holds a mops.toml
+        has_toml = "mops.toml" in files
+        for file in sorted(files):
             if file.endswith(".mo"):
-                mo_files.append(file_path)
+                yield os.path.join(root, file), has_toml
             elif file == "mops.toml":
-                mops_toml_files.append(file_path)
-                # Store the project directory (parent of the mops.toml file)
-                project_dir = os.path.dirname(file_path)
-                project_toml_map[project_dir] = file_path
-    return mo_files, mops_toml_files, project_toml_map
+                yield os.path.join(root, file), True
+
+def document_id(meta):
+    """Stable ID prefix derived from the file's relative path, so re-runs upsert in place."""
+    prefix = "motoko" if meta["file_type"] == "motoko" else "toml"
+    digest = hashlib.sha1(meta["rel_path"].encode("utf-8")).hexdigest()[:16]
+    return f"{prefix}_{digest}"
+
+def chunk_id(meta, chunk_index):
+    return f"{document_id(meta)}_{chunk_index}"
+
+def build_chunks(code, meta):
+    """Chunk one file; returns parallel lists (texts, metadatas, ids)."""
+    chunks = chunk_document(code, meta["file_type"], count_tokens=count_tokens, max_tokens=MAX_CHUNK_TOKENS)
+    texts, metadatas, ids = [], [], []
+    for chunk_index, chunk in enumerate(chunks):
+        texts.append(chunk["text"])
+        metadatas.append(dict(
+            meta,
+            chunk_index=chunk_index,
+            chunk_count=len(chunks),
+            start_line=chunk["start_line"],
+            end_line=chunk["end_line"],
+        ))
+        ids.append(chunk_id(meta, chunk_index))
+    return texts, metadatas, ids
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_manifest(chroma_dir):
+    """Load {rel_path: {"mtime", "size", "sha256", "has_toml", "ids"}} from a previous run.
+
+    Returns None when there is no manifest or it was written for another document layout.
+    """
+    path = os.path.join(chroma_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != MANIFEST_VERSION:
+        return None
+    return data["files"]
+
+def save_manifest(chroma_dir, manifest):
+    os.makedirs(chroma_dir, exist_ok=True)
+    path = os.path.join(chroma_dir, MANIFEST_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": manifest}, f)
+    # Atomic swap so an interrupted run never leaves a half-written manifest
+    os.replace(tmp_path, path)
+    # Precomputed project -> chunk ids, so project-filtered queries can scan just those chunks
+    project_index = {}
+    for rel_path, entry in manifest.items():
+        project_index.setdefault(project_of(rel_path), []).extend(entry["ids"])
+    save_project_index(project_index, chroma_dir)
+
+def iter_changes(file_entries, manifest, seen_paths):
+    """Yield (code, meta, stat, sha256) for new or changed files.
+
+    Files whose size and mtime match the manifest are skipped without being read;
+    otherwise the content hash decides whether the file really changed. Touched but
+    unmodified files get their manifest entry refreshed in place. Every visited
+    rel_path is added to seen_paths so removed files can be detected afterwards.
+    """
+    for file_path, has_toml in file_entries:
+        meta = get_metadata(file_path, SAMPLES_DIR, has_toml)
+        rel_path = meta["rel_path"]
+        seen_paths.add(rel_path)
+        stat = os.stat(file_path)
+        previous = manifest.get(rel_path)
+        if (previous and previous["mtime"] == stat.st_mtime and previous["size"] == stat.st_size
+                and previous["has_toml"] == has_toml):
+            continue
+        with open(file_path, "r", encoding="utf-8") as f:
+            code = f.read()
+        sha256 = content_hash(code)
+        if previous and previous["sha256"] == sha256 and previous["has_toml"] == has_toml:
+            manifest[rel_path] = dict(previous, mtime=stat.st_mtime, size=stat.st_size)
+            continue
+        yield code, meta, stat, sha256
+
+def iter_batches(changes, write_batch_size):
+    """Group changed files into write batches of about write_batch_size chunks.
+
+    A file's chunks never straddle two batches, so a committed batch always
+    covers complete files and the manifest can be checkpointed after it.
+    Yields (texts, metadatas, ids, files) where files is a list of (meta, stat, sha256, ids).
+    """
+    texts, metadatas, ids, files = [], [], [], []
+    for code, meta, stat, sha256 in changes:
+        chunk_texts, chunk_metas, chunk_ids = build_chunks(code, meta)
+        texts.extend(chunk_texts)
+        metadatas.extend(chunk_metas)
+        ids.extend(chunk_ids)
+        files.append((meta, stat, sha256, chunk_ids))
+        if len(texts) >= write_batch_size:
+            yield texts, metadatas, ids, files
+            texts, metadatas, ids, files = [], [], [], []
+    if files:
+        yield texts, metadatas, ids, files
+
+def load_lexical_index(chroma_dir, collection):
+    """The persisted BM25 index, rebuilt from the collection if it is missing or outdated."""
+    lexical = LexicalIndex.load(chroma_dir)
+    if lexical is None:
+        print("Building the lexical index from the existing collection...")
+        lexical = LexicalIndex()
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=1000, offset=offset)
+            if not page["ids"]:
+                break
+            for doc_id, doc in zip(page["ids"], page["documents"]):
+                lexical.add(doc_id, doc)
+            offset += len(page["ids"])
+        lexical.save(chroma_dir)
+        bump_generation(chroma_dir)
+    return lexical
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingest Motoko code samples into ChromaDB")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Number of documents encoded per batch (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Encode with a process pool of this many workers (default: single process)")
+    parser.add_argument("--write-batch-size", type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help=f"Chunks written to ChromaDB per committed batch (default: {DEFAULT_WRITE_BATCH_SIZE})")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignore the manifest and re-ingest every file")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     chroma_dir = os.path.join(os.getcwd(), "chromadb_data")
     chroma_client = chromadb.PersistentClient(path=chroma_dir)
     collection = chroma_client.get_or_create_collection("motoko_code_samples")
 
-    # Find all .mo and mops.toml files
-    mo_files, mops_toml_files, project_toml_map = find_project_files(SAMPLES_DIR)
-    print(f"Found {len(mo_files)} .mo files and {len(mops_toml_files)} mops.toml files.")
-
-    docs, embeddings, metadatas, ids = [], [], [], []
-    i = 0
-    # Process .mo files first
-    print("Processing .mo files...")
-    for file_path in tqdm(mo_files, desc="Processing .mo files", unit="file"):
-        # Check if this .mo file's project has a mops.toml file
-        project_dir = os.path.dirname(file_path)
-        has_toml = project_dir in project_toml_map
-        with open(file_path, "r", encoding="utf-8") as f:
-            code = f.read()
-        meta = get_metadata(file_path, SAMPLES_DIR, has_toml)
-        emb = get_embedding(code)
-        docs.append(code)
-        embeddings.append(emb)
-        metadatas.append(meta)
-        ids.append(f"motoko_sample_{i}")
-        print(f"Metadata for embedding {i}: {meta}")
-        i += 1
-    # Process mops.toml files
-    print("Processing mops.toml files...")
-    for file_path in tqdm(mops_toml_files, desc="Processing mops.toml files", unit="file"):
-        with open(file_path, "r", encoding="utf-8") as f:
-            toml_content = f.read()
-        meta = get_metadata(file_path, SAMPLES_DIR, has_toml=True)
-        emb = get_embedding(toml_content)
-        docs.append(toml_content)
-        embeddings.append(emb)
-        metadatas.append(meta)
-        ids.append(f"toml_sample_{i}")
-        print(f"Metadata for embedding {i}: {meta}")
-        i += 1
-    print(f"Storing {len(docs)} total files (Motoko + mops.toml) in ChromaDB...")
-    collection.add(
-        documents=docs,
-        embeddings=embeddings,
-        metadatas=metadatas,
-        ids=ids
-    )
+    manifest = None if args.full else load_manifest(chroma_dir)
+    if manifest is None:
+        # No manifest (first run, legacy walk-order IDs, or --full): start from a clean collection
+        print("Rebuilding the collection from scratch...")
+        chroma_client.delete_collection("motoko_code_samples")
+        collection = chroma_client.create_collection("motoko_code_samples")
+        manifest = {}
+        LexicalIndex().save(chroma_dir)
+        save_manifest(chroma_dir, manifest)
+        bump_generation(chroma_dir)
+    # BM25 index over Motoko identifiers, kept in step with the collection
+    lexical = load_lexical_index(chroma_dir, collection)
+
+    pool = None
+    if args.workers and args.workers > 1:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * args.workers)
+
+    seen_paths = set()
+    changes = iter_changes(iter_project_files(SAMPLES_DIR), manifest, seen_paths)
+    files_done = chunks_done = 0
+    embed_seconds = 0.0
+    progress = tqdm(desc="Ingesting", unit="chunk")
+    try:
+        # Pull-based pipeline: the walk only advances when the previous batch is written
+        for texts, metadatas, ids, files in iter_batches(changes, args.write_batch_size):
+            start_time = time.perf_counter()
+            embeddings = get_embeddings(texts, batch_size=args.batch_size, pool=pool)
+            embed_seconds += time.perf_counter() - start_time
+
+            # A changed file may now have fewer chunks than before
+            stale_ids = []
+            for meta, _, _, chunk_ids in files:
+                previous = manifest.get(meta["rel_path"])
+                if previous:
+                    current_ids = set(chunk_ids)
+                    stale_ids.extend(doc_id for doc_id in previous["ids"] if doc_id not in current_ids)
+            if stale_ids:
+                collection.delete(ids=stale_ids)
+            if ids:
+                collection.upsert(
+                    documents=texts,
+                    embeddings=embeddings,
+                    metadatas=metadatas,
+                    ids=ids
+                )
+            for doc_id in stale_ids:
+                lexical.remove(doc_id)
+            for doc_id, text in zip(ids, texts):
+                lexical.add(doc_id, text)
+            lexical.save(chroma_dir)
+
+            # Checkpoint: an interrupted run resumes after the last committed batch
+            for meta, stat, sha256, chunk_ids in files:
+                manifest[meta["rel_path"]] = {
+                    "mtime": stat.st_mtime,
+                    "size": stat.st_size,
+                    "sha256": sha256,
+                    "has_toml": meta["has_toml"],
+                    "ids": chunk_ids,
+                }
+            save_manifest(chroma_dir, manifest)
+            # Invalidate the result caches of running servers
+            bump_generation(chroma_dir)
+            files_done += len(files)
+            chunks_done += len(ids)
+            progress.update(len(ids))
+    finally:
+        progress.close()
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    # Files that disappeared from disk since the last run
+    removed_paths = [rel_path for rel_path in manifest if rel_path not in seen_paths]
+    stale_ids = [doc_id for rel_path in removed_paths for doc_id in manifest[rel_path]["ids"]]
+    if stale_ids:
+        print(f"Deleting {len(stale_ids)} chunks of {len(removed_paths)} removed files...")
+        collection.delete(ids=stale_ids)
+        for doc_id in stale_ids:
+            lexical.remove(doc_id)
+        lexical.save(chroma_dir)
+    for rel_path in removed_paths:
+        del manifest[rel_path]
+    save_manifest(chroma_dir, manifest)
+    if stale_ids:
+        bump_generation(chroma_dir)
+
+    print(f"{files_done} new or changed files ({chunks_done} chunks), "
+          f"{len(seen_paths) - files_done} unchanged, {len(removed_paths)} removed.")
+    if chunks_done and embed_seconds > 0:
+        print(f"Embedded {chunks_done} chunks in {embed_seconds:.1f}s ({chunks_done / embed_seconds:.1f} docs/sec)")
     print("Done!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,97 @@
+"""
+Context packing: turn ranked retrieval hits into a deduplicated, token-budgeted prompt context.
+
+Retrieval returns whole chunks in rank order. Exact copies (the same file in several
+forks) and near-duplicates add tokens without adding information, so they are dropped;
+the remaining chunks are added in rank order while they fit the budget. A chunk that
+does not fit is cut at a Motoko declaration boundary rather than mid-function.
+"""
+
+import hashlib
+import os
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from ingest.motoko_chunker import chunk_motoko_source
+
+# Approximate prompt tokens spent on retrieved context
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "3000"))
+# Word-shingle Jaccard similarity above which a chunk counts as a near-duplicate
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("RAG_NEAR_DUPLICATE_THRESHOLD", "0.8"))
+SHINGLE_SIZE = 5
+# Partial chunks smaller than this are not worth their separator and header
+MIN_PARTIAL_TOKENS = 64
+
+WORD_RE = re.compile(r"\S+")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English and code
+    return len(text) // 4 + 1
+
+
+def _shingles(text: str) -> Set[int]:
+    words = WORD_RE.findall(text)
+    if len(words) < SHINGLE_SIZE:
+        return {hash(" ".join(words))}
+    return {hash(" ".join(words[i:i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a: Set[int], b: Set[int]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _leading_part(doc: str, meta: Dict[str, Any], token_budget: int) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """The first declaration-aligned piece of doc that fits token_budget, if any."""
+    if meta.get("file_type", "motoko") != "motoko" or token_budget < MIN_PARTIAL_TOKENS:
+        return None
+    pieces = chunk_motoko_source(doc, max_chars=token_budget * 4, overlap_lines=0)
+    if not pieces or estimate_tokens(pieces[0]["text"]) > token_budget:
+        return None
+    first = pieces[0]
+    start_line = meta.get("start_line") or 1
+    return first["text"], dict(
+        meta,
+        start_line=start_line + first["start_line"] - 1,
+        end_line=start_line + first["end_line"] - 1,
+        truncated=True,
+    )
+
+
+def pack_context(docs: List[str], metadatas: List[Dict[str, Any]], token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 near_duplicate_threshold: float = NEAR_DUPLICATE_THRESHOLD) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """Select (docs, metadatas) in rank order: deduplicated and within token_budget.
+
+    Takes and returns the same shape as RetrievalEngine.retrieve_context(). The first
+    chunk that overflows the budget is cut at a declaration boundary if a useful part
+    fits; smaller chunks further down the ranking can still fill the remaining space.
+    """
+    packed_docs, packed_metas = [], []
+    seen_hashes = set()
+    seen_shingles: List[Set[int]] = []
+    remaining = token_budget
+    for doc, meta in zip(docs, metadatas):
+        if remaining < MIN_PARTIAL_TOKENS:
+            break
+        meta = meta or {}
+        digest = hashlib.sha1(" ".join(WORD_RE.findall(doc)).encode("utf-8")).hexdigest()
+        if digest in seen_hashes:
+            continue
+        shingles = _shingles(doc)
+        if any(_jaccard(shingles, other) >= near_duplicate_threshold for other in seen_shingles):
+            continue
+        tokens = estimate_tokens(doc)
+        if tokens > remaining:
+            part = _leading_part(doc, meta, remaining)
+            if part is None:
+                continue
+            doc, meta = part
+            tokens = estimate_tokens(doc)
+        seen_hashes.add(digest)
+        seen_shingles.append(shingles)
+        packed_docs.append(doc)
+        packed_metas.append(meta)
+        remaining -= tokens
+    return packed_docs, packed_metas
@@ -0,0 +1,76 @@
+"""
+Process-wide registry of configured Gemini models.
+
+genai.configure() drops the SDK's cached gRPC clients, so calling it per request
+pays a new channel and TLS handshake every time. The SDK is configured once here,
+and GenerativeModel instances are built once per (model name, generation config).
+Per-request settings are passed as generation_config overrides at call time,
+which the SDK merges into the model's defaults without rebuilding anything.
+
+The SDK takes about a second to import, so it is only imported on first use.
+"""
+
+import importlib.util
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+try:
+    GEMINI_SDK_AVAILABLE = importlib.util.find_spec("google.generativeai") is not None
+except ImportError:
+    GEMINI_SDK_AVAILABLE = False
+
+_lock = threading.Lock()
+_configured_key = None
+_models: Dict[Any, Any] = {}
+genai = None
+
+
+def _sdk():
+    """The google.generativeai module, imported on first use."""
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+    return genai
+
+
+def configure(api_key: Optional[str] = None) -> None:
+    """Configure the SDK once; only a different API key triggers a reconfigure."""
+    global _configured_key
+    api_key = api_key or os.getenv("GEMINI_API_KEY")
+    if _configured_key == api_key:
+        return
+    with _lock:
+        if _configured_key != api_key:
+            _sdk().configure(api_key=api_key)
+            _configured_key = api_key
+            _models.clear()
+
+
+def get_model(model_name: str, generation_config: Optional[Dict[str, Any]] = None, api_key: Optional[str] = None):
+    """Shared GenerativeModel for this model name and default generation config."""
+    if not GEMINI_SDK_AVAILABLE:
+        raise RuntimeError("Gemini SDK not installed. Install with: pip install google-generativeai")
+    configure(api_key)
+    key = (model_name, json.dumps(generation_config or {}, sort_keys=True))
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                model = _sdk().GenerativeModel(model_name, generation_config=generation_config)
+                _models[key] = model
+    return model
+
+
+def generation_overrides(temperature: Optional[float] = None, top_p: Optional[float] = None,
+                         max_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """Map OpenAI-style sampling parameters to a Gemini generation_config override."""
+    overrides = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_output_tokens": max_tokens,
+    }
+    return {name: value for name, value in overrides.items() if value is not None}
@@ -1,28 +1,17 @@
 import os
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from dotenv import load_dotenv
+from rag.retrieval import get_engine
+# Shared Gemini model registry (GEMINI_SDK_AVAILABLE is False without the SDK)
+from rag.gemini_client import GEMINI_SDK_AVAILABLE, get_model
 import requests
 import textwrap
 
-# Try to import the Gemini SDK
-try:
-    import google.generativeai as genai
-    GEMINI_SDK_AVAILABLE = True
-except ImportError:
-    GEMINI_SDK_AVAILABLE = False
-
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# ChromaDB setup
-CHROMA_DIR = os.path.join(os.getcwd(), "chromadb_data")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-collection = chroma_client.get_or_create_collection("motoko_code_samples")
-
-# Embedding function for retrieval
-embedding_fn = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+# Shared retrieval engine (embedder and collection are loaded on first query)
+engine = get_engine()
 
 # Gemini inference parameters
 GENERATION_CONFIG = {
@@ -33,12 +22,8 @@ GENERATION_CONFIG = {
 }
 MODEL_NAME = "models/gemini-2.5-flash"  # Gemini Flash 2.5
 
-def retrieve_context(query, n_results=10):
-    query_emb = embedding_fn([query])[0]
-    results = collection.query(query_embeddings=[query_emb], n_results=n_results)
-    docs = results.get("documents", [[]])[0]
-    metadatas = results.get("metadatas", [[]])[0]
-    return docs, metadatas
+def retrieve_context(query, n_results=10, where=None):
+    return engine.retrieve_context(query, n_results, where)
 
 def count_tokens_gemini_sdk(model, prompt):
     # Use the Gemini SDK to count tokens
@@ -47,12 +32,11 @@ def count_tokens_gemini_sdk(model, prompt):
     except Exception:
         return None
 
+# Pooled HTTP connections for the REST fallback
+http_session = requests.Session()
+
 def answer_with_gemini_sdk(query, context):
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(
-        MODEL_NAME,
-        generation_config=GENERATION_CONFIG
-    )
+    model = get_model(MODEL_NAME, GENERATION_CONFIG, api_key=GEMINI_API_KEY)
     prompt = f"Context:\n{context}\n\n Request: {query}\nAnswer:"
     num_tokens = count_tokens_gemini_sdk(model, prompt)
     response = model.generate_content(prompt)
@@ -69,7 +53,7 @@ def answer_with_gemini_rest(query, context):
         }],
         "generationConfig": GENERATION_CONFIG
     }
-    resp = requests.post(url, headers=headers, params=params, json=data)
+    resp = http_session.post(url, headers=headers, params=params, json=data)
     if resp.ok:
         # Gemini REST API does not return token count directly
         answer = resp.json()["candidates"][0]["content"]["parts"][0]["text"]
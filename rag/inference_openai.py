@@ -1,27 +1,17 @@
 import os
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from dotenv import load_dotenv
+from rag.retrieval import get_engine
 import openai
 
 # Load environment variables
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# ChromaDB setup
-CHROMA_DIR = os.path.join(os.getcwd(), "chromadb_data")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-collection = chroma_client.get_or_create_collection("motoko_code_samples")
+# Shared retrieval engine (embedder and collection are loaded on first query)
+engine = get_engine()
 
-# Embedding function for retrieval
-embedding_fn = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-
-def retrieve_context(query, n_results=3):
-    query_emb = embedding_fn([query])[0]
-    results = collection.query(query_embeddings=[query_emb], n_results=n_results)
-    docs = results.get("documents", [[]])[0]
-    metadatas = results.get("metadatas", [[]])[0]
-    return docs, metadatas
+def retrieve_context(query, n_results=3, where=None):
+    return engine.retrieve_context(query, n_results, where)
 
 def answer_with_openai(query, context):
     openai.api_key = OPENAI_API_KEY
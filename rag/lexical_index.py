@@ -0,0 +1,131 @@
+"""
+BM25 inverted index over Motoko identifiers, used next to vector search.
+
+MiniLM embeddings blur exact API names (`Principal.fromActor`, `icrc1_transfer`),
+so documents are also indexed lexically: every identifier is kept whole (dotted
+paths included) and split into its snake_case / camelCase parts. The ingester
+keeps the index in sync with the collection and persists it beside the ChromaDB
+data; RetrievalEngine fuses its ranking with the vector ranking.
+"""
+
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+LEXICAL_INDEX_FILENAME = "lexical_index.json"
+LEXICAL_INDEX_VERSION = 1
+
+# Standard BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*")
+CAMEL_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased identifier terms: whole dotted names, their segments and sub-words."""
+    terms = []
+    for identifier in IDENTIFIER_RE.findall(text):
+        terms.append(identifier.lower())
+        segments = identifier.split(".")
+        if len(segments) > 1:
+            terms.extend(segment.lower() for segment in segments)
+        for segment in segments:
+            parts = [part for part in segment.split("_") if part]
+            sub_terms = parts if len(parts) > 1 else []
+            sub_terms += [word for part in parts for word in CAMEL_RE.findall(part) if word != part]
+            terms.extend(term.lower() for term in sub_terms)
+    return terms
+
+
+class LexicalIndex:
+    def __init__(self):
+        self._doc_terms: Dict[str, Dict[str, int]] = {}  # doc id -> term frequencies
+        self._postings: Dict[str, Dict[str, int]] = {}   # term -> {doc id: term frequency}
+        self._doc_lengths: Dict[str, int] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_terms)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._doc_terms
+
+    def add(self, doc_id: str, text: str):
+        """Index (or re-index) one document."""
+        self.remove(doc_id)
+        self._insert(doc_id, dict(Counter(tokenize(text))))
+
+    def _insert(self, doc_id: str, term_counts: Dict[str, int]):
+        self._doc_terms[doc_id] = term_counts
+        length = sum(term_counts.values())
+        self._doc_lengths[doc_id] = length
+        self._total_length += length
+        for term, count in term_counts.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+
+    def remove(self, doc_id: str):
+        term_counts = self._doc_terms.pop(doc_id, None)
+        if term_counts is None:
+            return
+        self._total_length -= self._doc_lengths.pop(doc_id)
+        for term in term_counts:
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query: str, n_results: int = 10) -> List[Tuple[str, float]]:
+        """Top n_results (doc id, BM25 score) pairs for the query's identifier terms."""
+        if not self._doc_terms:
+            return []
+        doc_count = len(self._doc_terms)
+        avg_length = self._total_length / doc_count or 1.0
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self._doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n_results]
+
+    @classmethod
+    def load(cls, chroma_dir: str) -> Optional["LexicalIndex"]:
+        """The persisted index, or None if there is none (or it has an old format)."""
+        path = os.path.join(chroma_dir, LEXICAL_INDEX_FILENAME)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if data.get("version") != LEXICAL_INDEX_VERSION:
+            return None
+        index = cls()
+        for doc_id, term_counts in data["docs"].items():
+            index._insert(doc_id, term_counts)
+        return index
+
+    def save(self, chroma_dir: str):
+        """Write the index atomically next to the ChromaDB data."""
+        os.makedirs(chroma_dir, exist_ok=True)
+        path = os.path.join(chroma_dir, LEXICAL_INDEX_FILENAME)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": LEXICAL_INDEX_VERSION, "docs": self._doc_terms}, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """Merge several rankings of ids: each id scores sum(1 / (k + rank)) over the rankings."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
@@ -0,0 +1,147 @@
+"""
+Cross-encoder re-ranking of retrieval candidates.
+
+The bi-encoder (MiniLM embeddings) ranks chunks by comparing two independently
+computed vectors; a cross-encoder reads the query and the chunk together and
+orders the top of the list much better. RetrievalEngine over-fetches candidates,
+and this module re-scores them in batches on a small local model, caching each
+(query, chunk id) score. Scoring stops at a latency budget, in which case the
+query keeps its vector order.
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from rag.cache import TTLCache
+
+# Off by default; endpoints can also turn it on or off per request
+RERANK_ENABLED = os.getenv("RAG_RERANK", "0").lower() not in ("0", "false", "no")
+# Small CPU-friendly model; cross-encoder/ms-marco-TinyBERT-L-2-v2 is faster still
+RERANK_MODEL = os.getenv("RAG_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Candidates re-scored per query (at least n_results)
+RERANK_CANDIDATES = int(os.getenv("RAG_RERANK_CANDIDATES", "20"))
+RERANK_BATCH_SIZE = int(os.getenv("RAG_RERANK_BATCH_SIZE", "16"))
+# Tokens of each (query, chunk) pair the model reads; the cost grows with this
+RERANK_MAX_LENGTH = int(os.getenv("RAG_RERANK_MAX_LENGTH", "256"))
+# Scoring time per call after which unscored queries keep their vector order
+RERANK_BUDGET_MS = float(os.getenv("RAG_RERANK_BUDGET_MS", "250"))
+RERANK_SCORE_CACHE_SIZE = int(os.getenv("RAG_RERANK_SCORE_CACHE_SIZE", "8192"))
+RERANK_SCORE_CACHE_TTL = float(os.getenv("RAG_RERANK_SCORE_CACHE_TTL", "3600"))
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name: str = RERANK_MODEL, batch_size: int = RERANK_BATCH_SIZE,
+                 max_length: int = RERANK_MAX_LENGTH, budget_ms: float = RERANK_BUDGET_MS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.budget_ms = budget_ms
+        self._model = None
+        self._lock = threading.Lock()
+        self._load_thread = None
+        self._load_error = None
+        # (normalized query, chunk id) -> score; cleared when the collection changes
+        self.score_cache = TTLCache(maxsize=RERANK_SCORE_CACHE_SIZE, ttl=RERANK_SCORE_CACHE_TTL)
+        self._stats_lock = threading.Lock()
+        self._stats = {"queries": 0, "reranked": 0, "fallbacks": 0, "pairs_scored": 0, "score_seconds": 0.0}
+
+    @property
+    def model(self):
+        """The CrossEncoder, loaded on first use."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length)
+                    print(f"✅ Re-ranker loaded: {self.model_name}", file=sys.stderr)
+        return self._model
+
+    def start_loading(self) -> Optional[threading.Thread]:
+        """Load the model on a daemon thread, once; returns the loading thread (None if loaded)."""
+        with self._lock:
+            if self._model is not None:
+                return None
+            if self._load_thread is None:
+                self._load_thread = threading.Thread(target=self._load, name="rag-reranker-load", daemon=True)
+                self._load_thread.start()
+            return self._load_thread
+
+    def _load(self):
+        try:
+            self.model
+        except Exception as e:
+            self._load_error = str(e)
+            print(f"❌ Re-ranker failed to load, keeping vector order: {e}", file=sys.stderr)
+
+    def rerank_many(self, query_keys: List[str], queries: List[str], hits_per_query: List[List[Dict[str, Any]]],
+                    n_results: int) -> List[List[Dict[str, Any]]]:
+        """Top n_results of each query's hits by cross-encoder score, or by vector order if out of time.
+
+        query_keys are the cache keys of the queries (normalized text). Uncached pairs
+        of all queries are scored together in batches, query by query, so when the
+        budget runs out the earlier queries are still re-ranked. Scores computed before
+        the cut-off are cached and spare the next call the work. Loading the model
+        counts against the budget too: it is started in the background and waited
+        for only as long as the budget allows.
+        """
+        start = time.perf_counter()
+        deadline = start + self.budget_ms / 1000.0
+        load_thread = self.start_loading() if self._model is None else None
+        if load_thread is not None:
+            load_thread.join(max(deadline - time.perf_counter(), 0.0))
+        model = self._model
+        scores = [{} for _ in queries]
+        pending = []
+        for position, (key, hits) in enumerate(zip(query_keys, hits_per_query)):
+            for hit in hits:
+                score = self.score_cache.get((key, hit["id"]))
+                if score is None:
+                    pending.append((position, hit))
+                else:
+                    scores[position][hit["id"]] = score
+        scored = 0
+        for offset in range(0, len(pending), self.batch_size):
+            if model is None or time.perf_counter() >= deadline:
+                break
+            batch = pending[offset:offset + self.batch_size]
+            predicted = model.predict(
+                [(queries[position], hit["document"]) for position, hit in batch],
+                batch_size=self.batch_size, show_progress_bar=False
+            )
+            for (position, hit), score in zip(batch, predicted):
+                score = float(score)
+                scores[position][hit["id"]] = score
+                self.score_cache.put((query_keys[position], hit["id"]), score)
+            scored += len(batch)
+
+        reranked = []
+        fallbacks = 0
+        for hits, query_scores in zip(hits_per_query, scores):
+            if len(query_scores) < len({hit["id"] for hit in hits}):
+                # Out of time before this query was fully scored
+                fallbacks += 1
+                reranked.append(hits[:n_results])
+                continue
+            # sorted() is stable, so equal scores keep their vector order
+            ordered = sorted(hits, key=lambda hit: query_scores[hit["id"]], reverse=True)
+            reranked.append([dict(hit, rerank_score=query_scores[hit["id"]]) for hit in ordered[:n_results]])
+        with self._stats_lock:
+            self._stats["queries"] += len(queries)
+            self._stats["reranked"] += len(queries) - fallbacks
+            self._stats["fallbacks"] += fallbacks
+            self._stats["pairs_scored"] += scored
+            self._stats["score_seconds"] += time.perf_counter() - start
+        return reranked
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["model"] = self.model_name
+        stats["loaded"] = self._model is not None
+        stats["load_error"] = self._load_error
+        stats["budget_ms"] = self.budget_ms
+        stats["score_cache"] = self.score_cache.stats()
+        return stats
@@ -0,0 +1,469 @@
+"""
+Shared retrieval engine for every RAG entry point (rag/ scripts, API servers, MCP servers).
+
+One process-wide RetrievalEngine owns the SentenceTransformer embedder and the ChromaDB
+collection handle. Both (and the chromadb package itself) are loaded lazily on first use,
+so importing this module is cheap and every server shares the same query path. Servers
+call start_warm_up() to load them on a background thread while they start answering.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from rag.cache import TTLCache
+from rag.lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+from rag.reranker import CrossEncoderReranker, RERANK_ENABLED, RERANK_CANDIDATES
+
+# Reference point for the import-to-ready timing reported by warm-up
+IMPORTED_AT = time.perf_counter()
+
+CHROMA_DIR = os.path.join(os.getcwd(), "chromadb_data")
+COLLECTION_NAME = "motoko_code_samples"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# Query embedding cache (all-MiniLM-L6-v2 is uncased, so queries are normalized to lower case)
+EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", "1024"))
+EMBEDDING_CACHE_TTL = float(os.getenv("RAG_EMBEDDING_CACHE_TTL", "3600"))
+# Query result cache, dropped whenever the ingester bumps the collection generation
+RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "512"))
+RESULT_CACHE_TTL = float(os.getenv("RAG_RESULT_CACHE_TTL", "600"))
+
+_UNCHECKED = object()
+
+# Hybrid retrieval: vector hits fused with BM25 identifier hits (needs the ingester's lexical index)
+HYBRID_ENABLED = os.getenv("RAG_HYBRID", "1").lower() not in ("0", "false", "no")
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# Each ranking contributes n_results * HYBRID_OVERFETCH candidates to the fusion
+HYBRID_OVERFETCH = int(os.getenv("RAG_HYBRID_OVERFETCH", "2"))
+
+# Most queries accepted by one batch retrieval call
+MAX_BATCH_QUERIES = int(os.getenv("RAG_MAX_BATCH_QUERIES", "20"))
+
+# Load the embedder and collection in the background as soon as a server starts
+WARMUP_ENABLED = os.getenv("RAG_WARMUP", "1").lower() not in ("0", "false", "no")
+
+# Counter file next to the ChromaDB data, incremented on every ingester write
+GENERATION_FILENAME = "collection_generation"
+# {project: [chunk ids]} written by the ingester next to the ChromaDB data
+PROJECT_INDEX_FILENAME = "project_index.json"
+# Project-filtered queries over at most this many chunks are answered by an exact scan
+PROJECT_SCAN_MAX_IDS = int(os.getenv("RAG_PROJECT_SCAN_MAX_IDS", "5000"))
+PROJECT_SCAN_CACHE_SIZE = 32
+
+
+def read_generation(chroma_dir: str = CHROMA_DIR) -> int:
+    try:
+        with open(os.path.join(chroma_dir, GENERATION_FILENAME), "r", encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_generation(chroma_dir: str = CHROMA_DIR) -> int:
+    """Mark the collection as changed so every server drops its cached results."""
+    generation = read_generation(chroma_dir) + 1
+    os.makedirs(chroma_dir, exist_ok=True)
+    path = os.path.join(chroma_dir, GENERATION_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(str(generation))
+    os.replace(tmp_path, path)
+    return generation
+
+
+def build_where(project: Optional[str] = None, file_type: Optional[str] = None,
+                has_toml: Optional[bool] = None) -> Optional[Dict[str, Any]]:
+    """ChromaDB where filter for the metadata filters every entry point accepts (None = unfiltered)."""
+    conditions = [
+        {field: value}
+        for field, value in (("project", project), ("file_type", file_type), ("has_toml", has_toml))
+        if value is not None and value != ""
+    ]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def load_project_index(chroma_dir: str = CHROMA_DIR) -> Dict[str, List[str]]:
+    try:
+        with open(os.path.join(chroma_dir, PROJECT_INDEX_FILENAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_project_index(project_index: Dict[str, List[str]], chroma_dir: str = CHROMA_DIR):
+    os.makedirs(chroma_dir, exist_ok=True)
+    path = os.path.join(chroma_dir, PROJECT_INDEX_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(project_index, f)
+    os.replace(tmp_path, path)
+
+
+def _filter_project(where: Optional[Dict[str, Any]]) -> Optional[str]:
+    """The project a build_where() filter restricts to, if any."""
+    if not where:
+        return None
+    for condition in where.get("$and", [where]):
+        if isinstance(condition.get("project"), str):
+            return condition["project"]
+    return None
+
+
+class RetrievalEngine:
+    def __init__(self, chroma_dir: str = CHROMA_DIR, collection_name: str = COLLECTION_NAME,
+                 model_name: str = EMBEDDING_MODEL):
+        self.chroma_dir = chroma_dir
+        self.collection_name = collection_name
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._embedding_fn = None
+        self._client = None
+        self._collection = None
+        self.embedding_cache = TTLCache(maxsize=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL)
+        self.result_cache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+        self._generation = None
+        self._generation_stamp = _UNCHECKED
+        self._stats_lock = threading.Lock()
+        self._lexical_index = None
+        self._lexical_loaded = False
+        self._project_index = None
+        self.reranker = CrossEncoderReranker()
+        # (project, where) -> (ids, embedding matrix, documents, metadatas) for exact project scans
+        self.project_scan_cache = TTLCache(maxsize=PROJECT_SCAN_CACHE_SIZE, ttl=None)
+        self._stats = {"queries": 0, "embed_seconds": 0.0, "query_seconds": 0.0, "lexical_seconds": 0.0}
+        self._warm_up_thread = None
+        self._readiness = {"ready": False, "warming": False, "error": None, "chunks": None, "timings": {}}
+
+    @property
+    def embedding_fn(self):
+        """The SentenceTransformer embedding function, loaded on first use."""
+        if self._embedding_fn is None:
+            with self._lock:
+                if self._embedding_fn is None:
+                    from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+                    self._embedding_fn = SentenceTransformerEmbeddingFunction(model_name=self.model_name)
+        return self._embedding_fn
+
+    @property
+    def collection(self):
+        """The ChromaDB collection handle, opened on first use."""
+        if self._collection is None:
+            with self._lock:
+                if self._collection is None:
+                    import chromadb
+                    self._client = chromadb.PersistentClient(path=self.chroma_dir)
+                    self._collection = self._client.get_or_create_collection(self.collection_name)
+        return self._collection
+
+    @property
+    def lexical_index(self) -> Optional[LexicalIndex]:
+        """The ingester's BM25 index, loaded on first use and after each collection update."""
+        if not self._lexical_loaded:
+            with self._lock:
+                if not self._lexical_loaded:
+                    self._lexical_index = LexicalIndex.load(self.chroma_dir)
+                    self._lexical_loaded = True
+        return self._lexical_index
+
+    @property
+    def project_index(self) -> Dict[str, List[str]]:
+        """The ingester's project -> chunk ids index, loaded on first use and after each collection update."""
+        if self._project_index is None:
+            self._project_index = load_project_index(self.chroma_dir)
+        return self._project_index
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def warm_up(self) -> Dict[str, Any]:
+        """Load the collection and embedder and run one query embedding; returns readiness()."""
+        timings = {}
+        try:
+            start = time.perf_counter()
+            chunks = self.count()
+            timings["collection_seconds"] = round(time.perf_counter() - start, 3)
+            start = time.perf_counter()
+            self.embedding_fn(["warm up"])
+            timings["embedder_seconds"] = round(time.perf_counter() - start, 3)
+            if RERANK_ENABLED:
+                start = time.perf_counter()
+                self.reranker.model
+                timings["reranker_seconds"] = round(time.perf_counter() - start, 3)
+            timings["import_to_ready_seconds"] = round(time.perf_counter() - IMPORTED_AT, 3)
+            self._readiness.update(chunks=chunks, timings=timings, error=None)
+            if not chunks:
+                self._readiness["error"] = "collection is empty; run python -m ingest.motoko_samples_ingester"
+                print(f"⚠️  Retrieval engine loaded but collection '{self.collection_name}' is empty", file=sys.stderr)
+            else:
+                print(f"✅ Retrieval engine ready with {chunks} chunks, {timings['import_to_ready_seconds']}s after import "
+                      f"(collection {timings['collection_seconds']}s, embedder {timings['embedder_seconds']}s)", file=sys.stderr)
+            self._readiness["ready"] = bool(chunks)
+        except Exception as e:
+            self._readiness["error"] = str(e)
+            print(f"❌ Retrieval engine warm-up failed: {e}", file=sys.stderr)
+        finally:
+            self._readiness["warming"] = False
+        return self.readiness()
+
+    def start_warm_up(self, force: bool = False):
+        """Run warm_up() once on a daemon thread (no-op when RAG_WARMUP is off, unless forced)."""
+        if not (WARMUP_ENABLED or force):
+            return
+        with self._lock:
+            if self._warm_up_thread is not None:
+                return
+            self._readiness["warming"] = True
+            self._warm_up_thread = threading.Thread(target=self.warm_up, name="rag-warm-up", daemon=True)
+        self._warm_up_thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self._readiness["ready"]
+
+    def readiness(self) -> Dict[str, Any]:
+        """Readiness report for /ready endpoints."""
+        readiness = dict(self._readiness)
+        loaded = self._collection is not None and self._embedding_fn is not None
+        if not readiness["ready"] and not readiness["warming"] and (readiness["chunks"] == 0 or loaded):
+            # Loaded by a query without warm-up, or empty at warm-up and since ingested
+            chunks = self.count()
+            if chunks:
+                self._readiness.update(ready=True, chunks=chunks, error=None)
+                readiness = dict(self._readiness)
+        return readiness
+
+    def embed(self, queries: List[str]) -> List[Any]:
+        """Embed queries, serving repeated ones from the cache and encoding the rest in one call."""
+        keys = [normalize_query(query) for query in queries]
+        embeddings = [self.embedding_cache.get(key) for key in keys]
+        missing = {}
+        for key, embedding in zip(keys, embeddings):
+            if embedding is None and key not in missing:
+                missing[key] = len(missing)
+        if missing:
+            start = time.perf_counter()
+            fresh = list(self.embedding_fn(list(missing)))
+            self._record("embed_seconds", time.perf_counter() - start)
+            for key, position in missing.items():
+                self.embedding_cache.put(key, fresh[position])
+            embeddings = [
+                embedding if embedding is not None else fresh[missing[key]]
+                for key, embedding in zip(keys, embeddings)
+            ]
+        return embeddings
+
+    def search(self, query: str, n_results: int = 10, where: Optional[Dict[str, Any]] = None,
+               rerank: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """Return the n_results nearest chunks as {"id", "document", "metadata", "distance"} dicts.
+
+        rerank re-scores over-fetched candidates with the cross-encoder (default: RAG_RERANK).
+        """
+        return self.search_many([query], n_results, where, rerank)[0]
+
+    def search_many(self, queries: List[str], n_results: int = 10, where: Optional[Dict[str, Any]] = None,
+                    rerank: Optional[bool] = None) -> List[List[Dict[str, Any]]]:
+        """search() for several queries: one embedding call and one collection.query for all cache misses."""
+        if RERANK_ENABLED if rerank is None else rerank:
+            # Candidates come from the (cached) first stage; re-ranked lists are not cached,
+            # since a re-ranking cut short by the latency budget should not stick
+            candidates = self.search_many(queries, max(n_results, RERANK_CANDIDATES), where, rerank=False)
+            return self.reranker.rerank_many([normalize_query(query) for query in queries], queries,
+                                             candidates, n_results)
+        embeddings = self.embed(queries)
+        self._check_generation()
+        cache_keys = [_result_cache_key(emb, n_results, where, query) for query, emb in zip(queries, embeddings)]
+        hits_per_query = [self.result_cache.get(key) for key in cache_keys]
+        missing = {}
+        for query, key, emb, hits in zip(queries, cache_keys, embeddings, hits_per_query):
+            if hits is None and key not in missing:
+                missing[key] = (query, emb)
+        if missing:
+            lexical = self.lexical_index if HYBRID_ENABLED else None
+            fetch = n_results * HYBRID_OVERFETCH if lexical else n_results
+            query_embs = [emb for _, emb in missing.values()]
+            start = time.perf_counter()
+            project = _filter_project(where)
+            project_ids = self.project_index.get(project) if project is not None else None
+            if project_ids is not None and len(project_ids) <= PROJECT_SCAN_MAX_IDS:
+                # Small project: exact scan over its precomputed ids instead of a filtered ANN search
+                fresh_hits = self._scan_project(project, project_ids, query_embs, fetch, where)
+            else:
+                results = self.collection.query(query_embeddings=query_embs, n_results=fetch, where=where)
+                fresh_hits = [_hits_from_results(results, position) for position in range(len(missing))]
+            self._record("query_seconds", time.perf_counter() - start, queries=len(missing))
+            if lexical:
+                start = time.perf_counter()
+                fresh_hits = self._fuse_lexical(
+                    lexical, [query for query, _ in missing.values()], fresh_hits, fetch, n_results, where
+                )
+                self._record("lexical_seconds", time.perf_counter() - start)
+            fresh = dict(zip(missing, fresh_hits))
+            for key, hits in fresh.items():
+                self.result_cache.put(key, hits)
+            hits_per_query = [hits if hits is not None else fresh[key] for key, hits in zip(cache_keys, hits_per_query)]
+        return [list(hits) for hits in hits_per_query]
+
+    def _scan_project(self, project: str, project_ids: List[str], query_embs: List[Any], n_results: int,
+                      where: Dict[str, Any]) -> List[List[Dict[str, Any]]]:
+        """Nearest chunks among one project's ids by exact squared-L2 distance (ChromaDB's default metric)."""
+        cache_key = (project, json.dumps(where, sort_keys=True))
+        data = self.project_scan_cache.get(cache_key)
+        if data is None:
+            fetched = self.collection.get(ids=project_ids, where=where,
+                                          include=["embeddings", "documents", "metadatas"])
+            matrix = np.asarray(fetched["embeddings"], dtype=np.float32).reshape(len(fetched["ids"]), -1)
+            data = (fetched["ids"], matrix, fetched["documents"], fetched["metadatas"])
+            self.project_scan_cache.put(cache_key, data)
+        ids, matrix, docs, metadatas = data
+        hits_per_query = []
+        for query_emb in query_embs:
+            if not ids:
+                hits_per_query.append([])
+                continue
+            distances = ((matrix - np.asarray(query_emb, dtype=np.float32)) ** 2).sum(axis=1)
+            order = np.argsort(distances)[:n_results]
+            hits_per_query.append([
+                {"id": ids[i], "document": docs[i], "metadata": metadatas[i] or {}, "distance": float(distances[i])}
+                for i in order
+            ])
+        return hits_per_query
+
+    def _fuse_lexical(self, lexical: LexicalIndex, queries: List[str], vector_hits: List[List[Dict[str, Any]]],
+                      fetch: int, n_results: int, where: Optional[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Re-rank each query's vector hits together with its BM25 hits by reciprocal-rank fusion."""
+        lexical_ids = [[doc_id for doc_id, _ in lexical.search(query, fetch)] for query in queries]
+        # Lexical-only hits are fetched in one call; the where filter applies to them too
+        documents = {hit["id"]: hit for hits in vector_hits for hit in hits}
+        unknown = sorted({doc_id for ids in lexical_ids for doc_id in ids if doc_id not in documents})
+        if unknown:
+            fetched = self.collection.get(ids=unknown, where=where, include=["documents", "metadatas"])
+            for doc_id, doc, meta in zip(fetched["ids"], fetched["documents"], fetched["metadatas"]):
+                documents[doc_id] = {"id": doc_id, "document": doc, "metadata": meta or {}, "distance": None}
+        fused = []
+        for hits, ids in zip(vector_hits, lexical_ids):
+            own = {hit["id"]: hit for hit in hits}
+            ranking = reciprocal_rank_fusion(
+                [[hit["id"] for hit in hits], [doc_id for doc_id in ids if doc_id in documents]], k=RRF_K
+            )
+            # Distances are only meaningful for this query's own vector hits
+            fused.append([own.get(doc_id) or dict(documents[doc_id], distance=None) for doc_id in ranking[:n_results]])
+        return fused
+
+    def retrieve_context(self, query: str, n_results: int = 10, where: Optional[Dict[str, Any]] = None,
+                         rerank: Optional[bool] = None) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """Return (docs, metadatas) for the n_results nearest chunks matching the where filter."""
+        return self.retrieve_many([query], n_results, where, rerank)[0]
+
+    def retrieve_many(self, queries: List[str], n_results: int = 10, where: Optional[Dict[str, Any]] = None,
+                      rerank: Optional[bool] = None) -> List[Tuple[List[str], List[Dict[str, Any]]]]:
+        """retrieve_context() for a batch of queries, in query order."""
+        return [
+            ([hit["document"] for hit in hits], [hit["metadata"] for hit in hits])
+            for hits in self.search_many(queries, n_results, where, rerank)
+        ]
+
+    def _check_generation(self):
+        """Drop cached results when the ingester has written a new collection version."""
+        path = os.path.join(self.chroma_dir, GENERATION_FILENAME)
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._generation_stamp:
+            return
+        generation = read_generation(self.chroma_dir)
+        if generation != self._generation:
+            self.result_cache.clear()
+            self.project_scan_cache.clear()
+            self.reranker.score_cache.clear()
+            self._project_index = None
+            self._lexical_loaded = False
+            self._generation = generation
+        self._generation_stamp = stamp
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["embedding_cache"] = self.embedding_cache.stats()
+        stats["result_cache"] = self.result_cache.stats()
+        stats["reranker"] = self.reranker.stats()
+        stats["generation"] = self._generation
+        return stats
+
+    def _record(self, key: str, seconds: float, queries: int = 0):
+        with self._stats_lock:
+            self._stats[key] += seconds
+            self._stats["queries"] += queries
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a query: case-folded with whitespace collapsed."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+def _result_cache_key(query_emb, n_results: int, where: Optional[Dict[str, Any]], query: str):
+    digest = hashlib.sha1(np.asarray(query_emb, dtype=np.float32).tobytes()).hexdigest()
+    # The embedding ignores case but BM25 terms do not ("fromActor" also yields "from", "actor")
+    terms = tuple(sorted(set(tokenize(query)))) if HYBRID_ENABLED else None
+    return digest, terms, n_results, json.dumps(where, sort_keys=True) if where else None
+
+
+def _hits_from_results(results, position: int) -> List[Dict[str, Any]]:
+    """Turn row `position` of a collection.query() result into a list of hit dicts."""
+    ids = (results.get("ids") or [[]])[position]
+    docs = (results.get("documents") or [[]])[position]
+    metadatas = (results.get("metadatas") or [[]])[position]
+    distances = (results.get("distances") or [[None] * len(ids)])[position]
+    return [
+        {"id": doc_id, "document": doc, "metadata": meta or {}, "distance": distance}
+        for doc_id, doc, meta, distance in zip(ids, docs, metadatas, distances)
+    ]
+
+
+def format_context_result(index: int, doc: str, meta: Dict[str, Any], max_chars: Optional[int] = None) -> Dict[str, Any]:
+    """Context entry in the shape returned by the MCP endpoints."""
+    content = doc
+    if max_chars is not None and len(doc) > max_chars:
+        content = doc[:max_chars] + "..."
+    return {
+        "index": index,
+        "filename": meta.get("filename", "unknown"),
+        "project": meta.get("project") or meta.get("folders", "unknown"),
+        "file_type": meta.get("file_type", "unknown"),
+        "has_toml": meta.get("has_toml", False),
+        "content": content,
+        "full_path": meta.get("rel_path", "unknown"),
+        "start_line": meta.get("start_line"),
+        "end_line": meta.get("end_line"),
+        "truncated": meta.get("truncated", False)
+    }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> RetrievalEngine:
+    """Process-wide RetrievalEngine shared by all entry points."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RetrievalEngine()
+    return _engine
+
+
+def retrieve_context(query: str, n_results: int = 10, where: Optional[Dict[str, Any]] = None,
+                     rerank: Optional[bool] = None) -> Tuple[List[str], List[Dict[str, Any]]]:
+    return get_engine().retrieve_context(query, n_results, where, rerank)